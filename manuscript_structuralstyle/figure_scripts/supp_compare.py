@@ -86,11 +86,11 @@ for k,model in enumerate(models):
     
     # Plot
 
-    vp.plot2D(file,'comp_field',bounds=bounds,ax=ax,
-              cmap=cm,contours=True)
-
-    vp.plot2D(file,'noninitial_plastic_strain',bounds=bounds,ax=ax,
-              cmap=cm_strain,opacity=opacity_strain,clim=lim_strain)
+    vp.plot2D_multi(file,[('comp_field',dict(cmap=cm,contours=True)),
+                          ('noninitial_plastic_strain',
+                           dict(cmap=cm_strain,opacity=opacity_strain,
+                                clim=lim_strain))],
+                    bounds=bounds,axs=ax)
     
     ax.set_title(names[k] + ': '+ str(inv_times[k]-times[k]) + ' Myr',fontsize=8)
     ax.tick_params(axis='both',labelsize=6)
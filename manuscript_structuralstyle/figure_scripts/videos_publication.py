@@ -7,9 +7,6 @@ import shutil
 import numpy as np
 import matplotlib.pyplot as plt
 from matplotlib.colors import ListedColormap
-import cv2
-
-from tqdm import tqdm
 
 from riftinversion import vtk_plot as vp
 
@@ -45,7 +42,6 @@ invert_times_fast[1] = 39.5
 invert_times_all = invert_times_slow + invert_times_fast
 
 model_step = 0.1
-image_dir = 'images/'
 
 # Set up directory for videos
 output_dir = 'videos_publication/'
@@ -79,6 +75,78 @@ bar=False
 # Colorbar label size
 cbar_label = 8
 
+def plot_frame(frame,session):
+    """
+    Plot one video frame. Run in a worker of vp.make_video, which passes the
+    worker's render session.
+    """
+    step,file = frame
+    time = step*model_step
+    
+    # Set up figure and plot
+    fig,axs = plt.subplots(2,2,dpi=150,figsize=(7,5))
+    
+    axs = axs.flatten()
+
+    axs[0].set_title(str(round(time,1)) +' Ma',loc='left')
+    
+    axs[1].set_title('Strain',loc='center')
+    axs[2].set_title('Strain Rate')
+    axs[3].set_title('Viscosity')
+    
+    # Read and clip each file once for all four panels
+    panels = [('comp_field',dict(cmap=cm,colorbar=False,contours=True)),
+              ('plastic_strain',dict(cmap=opaque_cm,colorbar=bar,
+                                     clim=lim_strain)),
+              ('strain_rate',dict(cmap=opaque_cm_rev,log_scale=True,
+                                  colorbar=bar,clim=lim_strainrate)),
+              ('viscosity',dict(cmap=opaque_cm,log_scale=True,
+                                colorbar=bar,clim=lim_viscosity))]
+    
+    vp.plot2D_multi(file,panels,bounds=[250,750,450,620],axs=axs,
+                    session=session)
+    
+    # Format axes
+    axs[2].set_xlabel('X Position (km)')
+    axs[3].set_xlabel('X Position (km)')
+    axs[0].set_ylabel('Y Position (km)')
+    axs[2].set_ylabel('Y Position (km)')
+
+    
+    # Add colorbars
+    cax = vp.add_colorbar(fig,vmin=lim_strain[0],vmax=lim_strain[1],
+                          cmap=opaque_cm,
+                        location=[0.7,0.5,0.2,0.02])
+
+    cax.tick_params(axis='both',labelsize=cbar_label)
+    cax.set_title('Plastic Strain',fontsize=cbar_label,pad=0)
+    cax.set_xticks([0,1,2,3,4,5])
+    
+    cax2 = vp.add_colorbar(fig,vmin=lim_strainrate[0],vmax=lim_strainrate[1],
+                          cmap=opaque_cm_rev,log=True,
+                        location=[0.2,0.04,0.2,0.02])
+
+    cax2.tick_params(axis='both',labelsize=cbar_label,pad=0)
+    cax2.set_title('Strain Rate ($s^{-1}$)',fontsize=cbar_label,pad=0)  
+    
+    cax3 = vp.add_colorbar(fig,vmin=lim_viscosity[0],vmax=lim_viscosity[1],
+                          cmap=opaque_cm,log=True,
+                        location=[0.7,0.04,0.2,0.02])
+
+    cax3.tick_params(axis='both',labelsize=cbar_label,pad=0)
+    cax3.set_title('Viscosity ($Pa \cdot s$)',fontsize=cbar_label,pad=0)  
+
+    cax_comp = vp.add_colorbar(fig,cmap=cm_bar,
+                    location=[0.1,0.45,0.05,0.12],ticks=[0.125,0.375,0.625,0.875],
+                    orientation='vertical')
+
+    cax_comp.tick_params(labelsize=cbar_label)
+
+    cax_comp.set_yticklabels(['Asthenosphere','Mantle Lithosphere',
+                              'Lower Crust','Upper Crust'])
+    
+    return(fig)
+
 # Loop through each model
 for x,model in enumerate(all_models):  
     
@@ -95,109 +163,9 @@ for x,model in enumerate(all_models):
     
     files = vp.get_pvtu(directory,timesteps)
     
-    # Clear image directory
-    try:
-        shutil.rmtree(image_dir)
-    except:
-        print("Creating new image directory...")
-    else:
-        print("Cleared existing image directory...")
-    
-    os.makedirs(image_dir,exist_ok=False)
-    
-    # Plot each timestep
-    for k,step in enumerate(tqdm(timesteps)):
-        time = step*model_step
-        time_str = str(round(time,1)).zfill(5).replace('.','-')
-        
-        # Set up figure and plot
-        fig,axs = plt.subplots(2,2,dpi=150,figsize=(7,5))
-        
-        axs = axs.flatten()
-    
-        axs[0].set_title(str(round(time,1)) +' Ma',loc='left')
-        
-        axs[1].set_title('Strain',loc='center')
-        
-        vp.plot2D(files[k],'comp_field',bounds=[250,750,450,620],ax=axs[0],
-                  cmap=cm,colorbar=False,contours=True)
-        vp.plot2D(files[k],'plastic_strain',bounds=[250,750,450,620],ax=axs[1],
-                  cmap=opaque_cm,colorbar=bar,clim=lim_strain)
-    
-        axs[2].set_title('Strain Rate')
-        
-        
-        vp.plot2D(files[k],'strain_rate',bounds=[250,750,450,620],ax=axs[2],
-                  cmap=opaque_cm_rev,log_scale=True,
-                  colorbar=bar,clim=lim_strainrate)
-        
-        axs[3].set_title('Viscosity')
-        
-        vp.plot2D(files[k],'viscosity',bounds=[250,750,450,620],ax=axs[3],
-                  cmap=opaque_cm,log_scale=True,
-                  colorbar=bar,clim=lim_viscosity)
-        
-        # Format axes
-        axs[2].set_xlabel('X Position (km)')
-        axs[3].set_xlabel('X Position (km)')
-        axs[0].set_ylabel('Y Position (km)')
-        axs[2].set_ylabel('Y Position (km)')
-
-        
-        # Add colorbars
-        cax = vp.add_colorbar(fig,vmin=lim_strain[0],vmax=lim_strain[1],
-                              cmap=opaque_cm,
-                            location=[0.7,0.5,0.2,0.02])
-
-        cax.tick_params(axis='both',labelsize=cbar_label)
-        cax.set_title('Plastic Strain',fontsize=cbar_label,pad=0)
-        cax.set_xticks([0,1,2,3,4,5])
-        
-        cax2 = vp.add_colorbar(fig,vmin=lim_strainrate[0],vmax=lim_strainrate[1],
-                              cmap=opaque_cm_rev,log=True,
-                            location=[0.2,0.04,0.2,0.02])
-
-        cax2.tick_params(axis='both',labelsize=cbar_label,pad=0)
-        cax2.set_title('Strain Rate ($s^{-1}$)',fontsize=cbar_label,pad=0)  
-        
-        cax3 = vp.add_colorbar(fig,vmin=lim_viscosity[0],vmax=lim_viscosity[1],
-                              cmap=opaque_cm,log=True,
-                            location=[0.7,0.04,0.2,0.02])
-
-        cax3.tick_params(axis='both',labelsize=cbar_label,pad=0)
-        cax3.set_title('Viscosity ($Pa \cdot s$)',fontsize=cbar_label,pad=0)  
-
-        cax_comp = vp.add_colorbar(fig,cmap=cm_bar,
-                        location=[0.1,0.45,0.05,0.12],ticks=[0.125,0.375,0.625,0.875],
-                        orientation='vertical')
-
-        cax_comp.tick_params(labelsize=cbar_label)
-
-        cax_comp.set_yticklabels(['Asthenosphere','Mantle Lithosphere',
-                                  'Lower Crust','Upper Crust'])
-    
-        #plt.tight_layout()
-        fig.savefig(image_dir+time_str+'.jpg')
-        
-        fig.clear()
-        plt.close(fig)
-        
-    # Make movie
-    img_paths = [image_dir+file for file in sorted(os.listdir(image_dir)) if file.endswith('.jpg')]
-    
-    frame = cv2.imread(img_paths[0])
-    height,width,layers = frame.shape
-    
-    fourcc = cv2.VideoWriter_fourcc(*'mp4v')
-    
+    # Render frames in parallel and write movie directly
     frate = 2/model_step
     
     name = output_dir + names[x] +'.mp4'
     
-    video = cv2.VideoWriter(name, fourcc, frate, (width,height))
-    
-    for img in img_paths:
-        video.write(cv2.imread(img))
-    
-    cv2.destroyAllWindows()
-    video.release()
+    vp.make_video(plot_frame,list(zip(timesteps,files)),name,frate)
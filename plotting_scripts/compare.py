@@ -57,17 +57,13 @@ axs[1].set_title('Model 2: '+ str(time2)  +' Ma',loc='left')
 
 axs[2].set_title('Plastic Strain',loc='center')
 
-vp.plot2D(file1,'comp_field',bounds=bounds,ax=axs[0],
-            cmap=cm,colorbar=False)
+# Read and clip each file once for both of its panels
+panels = [('comp_field',dict(cmap=cm,colorbar=False)),
+          ('plastic_strain',dict(cmap=opaque_cm,colorbar=bar,clim=lim_strain))]
 
-vp.plot2D(file2,'comp_field',bounds=bounds,ax=axs[1],
-            cmap=cm,colorbar=False)
+vp.plot2D_multi(file1,panels,bounds=bounds,axs=[axs[0],axs[2]])
 
-vp.plot2D(file1,'plastic_strain',bounds=bounds,ax=axs[2],
-            cmap=opaque_cm,colorbar=bar,clim=lim_strain)
-
-vp.plot2D(file2,'plastic_strain',bounds=bounds,ax=axs[3],
-            cmap=opaque_cm,colorbar=bar,clim=lim_strain)
+vp.plot2D_multi(file2,panels,bounds=bounds,axs=[axs[1],axs[3]])
 
 plt.tight_layout()
 
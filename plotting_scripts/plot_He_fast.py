@@ -11,6 +11,7 @@ from matplotlib import rc
 rc("pdf", fonttype=42)
 
 import vtk_plot as vp
+import topography as tp
 
 # The following 8 models need to be plotted
 # slow_cold_half 080122_rip_a
@@ -72,15 +73,7 @@ for k,model in enumerate(models):
     topo_base = r'/mnt/f44f06b4-89ef-4d7c-a41d-6dbf331c8d4e/riftinversion_production/'
     topo_suffix = r'/output_ri_rift/'
     topo_dir = topo_base + model + topo_suffix
-    topo_allfiles = os.listdir(topo_dir)
-    topo_files = []
-    for tfile in topo_allfiles:
-        if tfile.startswith('topography'):
-            topo_files.append(tfile)
-            
-    topo_files.sort()            
-    topo = os.path.join(topo_dir,topo_files[-1])
-    print(topo_files[-1])
+    topo = tp.Topography(topo_dir).last()
     
     surface_particles = vp.get_surface_particles(mesh,topo,buffer=1000)
     surface_ids = surface_particles.index
@@ -2,14 +2,23 @@
 Functions for forward modeling of thermochronometric ages
 """
 import warnings
+import functools
 
 import numpy as np
 import matplotlib.pyplot as plt
 from scipy.optimize import fsolve
-from scipy.integrate import romb
-from scipy.linalg import solve_banded
+from scipy.integrate import romb,simpson
+from scipy.linalg import lapack
 from scipy.interpolate import griddata
 
+try:
+    import numba
+except ImportError:
+    numba = None
+
+# Maximum number of factorized diffusion steps kept by the operator cache
+OPERATOR_CACHE_SIZE = 1024
+
 def tridiag(a, b, c, diag_length):
     """
     Set up a tridiagonal matrix from the values for the 3 diagonals (a,b,c)
@@ -266,6 +275,78 @@ def calculate_He_production_rate(U238_molg,U235_molg,Th_molg):
     return(He_production)
     
 
+def K_wt2molg(K):
+    """
+    Convert concentration of K from wt% to mol/g of K40
+
+    Parameters
+    ----------
+    K : float
+        K concentration (wt%)
+
+    Returns
+    -------
+    K40_molg : float
+        K40 (mol/g)
+    """
+    # Atomic abundance of K40 and atomic mass of K
+    K40_abundance = 1.167e-4
+    K_mass = 39.0983
+    
+    K40_molg = (K/100)*K40_abundance/K_mass
+    
+    return(K40_molg)
+
+def calculate_Ar_production_rate(K40_molg):
+    """
+    Calculate radiogenic Ar40 production rate as a function of K40.
+    
+    Decay constants after Steiger and Jager, 1977.
+
+    Parameters
+    ----------
+    K40_molg : float
+        K40 (mol/g)
+
+    Returns
+    -------
+    Ar_production : float
+        Ar40 production (mol/g)
+
+    """
+    lambda_e = 0.581e-10
+    
+    Ar_production = lambda_e*K40_molg
+    
+    return(Ar_production)
+
+def calculate_Ar_ages(Ar_molg,K40_molg):
+    """
+    Calculate K-Ar ages. Works on single values or arrays.
+    
+    Decay constants after Steiger and Jager, 1977.
+
+    Parameters
+    ----------
+    Ar_molg : float or NumPy array
+        Amount of radiogenic Ar40 (mol/g)
+    K40_molg : float or NumPy array
+        Amount of K40 (mol/g)
+
+    Returns
+    -------
+    age_Ma : float or NumPy array
+        Calculated K-Ar age
+
+    """
+    lambda_e = 0.581e-10
+    lambda_total = 5.543e-10
+    
+    age = np.log1p((lambda_total/lambda_e)*(Ar_molg/K40_molg))/lambda_total
+    age_Ma = age/1e6
+    
+    return(age_Ma)
+
 def calculate_node_positions(node_spacing,radius):
     """
     Calculate node positions given spacing and radius.
@@ -342,7 +423,7 @@ def sum_He_shells(x,node_positions,radius,nodes,print_He=True):
     v_shells = v*shell_fraction
     
     # Integrate weighted radial profile
-    He_molg = romb(v_shells)
+    He_molg = integrate_shells(v_shells)
     He_nccg = He_molg * 22.4e12
     
     if print_He==True:
@@ -351,6 +432,36 @@ def sum_He_shells(x,node_positions,radius,nodes,print_He=True):
 
     return(He_molg,v)
 
+def integrate_shells(v_shells):
+    """
+    Integrate shell-weighted radial He profile(s) along the last axis.
+    
+    Uses Romberg integration when the number of nodes is 2^k+1 (e.g. the 
+    default of 513). Other node counts use Simpson's rule, which agrees 
+    with Romberg to <0.001% at 513 nodes, so reduced grids (e.g. 100 or 
+    200 nodes) can be used.
+
+    Parameters
+    ----------
+    v_shells : NumPy array
+        Radial profile(s) of He scaled by shell fraction.
+
+    Returns
+    -------
+    He_molg : float or NumPy array
+        Total amount (mol/g) of He within the modeled crystal(s).
+
+    """
+    nodes = np.shape(v_shells)[-1]
+    
+    # Romberg requires one plus a power of 2 samples
+    if (nodes > 1) and ((nodes-1) & (nodes-2) == 0):
+        He_molg = romb(v_shells,axis=-1)
+    else:
+        He_molg = simpson(v_shells,axis=-1)
+    
+    return(He_molg)
+
 def calculate_age(He_molg,U238_molg,U235_molg,Th_molg):
     """
     Calculate (U-Th)/He age.
@@ -396,11 +507,84 @@ def calculate_age(He_molg,U238_molg,U235_molg,Th_molg):
     
     warnings.filterwarnings('ignore','The iteration is not making good progress')
     
-    age = float(fsolve(age_equation,1e6))
+    age = float(fsolve(age_equation,1e6)[0])
     age_Ma = age/1e6
     
     return(age_Ma)
 
+def calculate_ages(He_molg,U238_molg,U235_molg,Th_molg,iterations=6):
+    """
+    Calculate (U-Th)/He ages for arrays of He and parent isotopes at once.
+    
+    Vectorized alternative to calculate_age. Uses a closed-form first guess
+    that treats all He as produced with a single, production-weighted decay
+    constant, then refines with a fixed number of Newton iterations on the
+    full decay equation. As in calculate_age, no alpha correction is 
+    applied here.
+
+    Parameters
+    ----------
+    He_molg : NumPy array
+        Amount of He (mol/g)
+    U238_molg : NumPy array or float
+        Amount of U238 (mol/g)
+    U235_molg : NumPy array or float
+        Amount of U235 (mol/g)
+    Th_molg : NumPy array or float
+        Amount of Th232 (mol/g)
+    iterations : int, optional
+        Number of Newton iterations. The default is 6.
+
+    Returns
+    -------
+    age_Ma : NumPy array
+        Calculated (U-Th)/He ages
+
+    """
+    
+    lambda238 = -np.log(1/2)/4.468e9
+    lambda235 = -np.log(1/2)/7.04e8
+    lambda232 = -np.log(1/2)/1.40e10
+    
+    He_molg = np.asarray(He_molg,dtype=np.float64)
+    
+    ageterm_238 = 8*np.asarray(U238_molg,dtype=np.float64)
+    ageterm_235 = 7*np.asarray(U235_molg,dtype=np.float64)
+    ageterm_232 = 6*np.asarray(Th_molg,dtype=np.float64)
+    
+    # First guess with single decay constant weighted by He production
+    parent_total = ageterm_238 + ageterm_235 + ageterm_232
+    production = (
+        lambda238*ageterm_238 + lambda235*ageterm_235 + lambda232*ageterm_232
+        )
+    lambda_eff = production/parent_total
+    
+    t = np.log1p(He_molg/parent_total)/lambda_eff
+    
+    # Newton iterations on the decay equation
+    for n in range(iterations):
+        # Use expm1 to keep precision for young ages
+        expm238 = np.expm1(lambda238*t)
+        expm235 = np.expm1(lambda235*t)
+        expm232 = np.expm1(lambda232*t)
+        
+        root = (
+            ageterm_238*expm238 + ageterm_235*expm235 + ageterm_232*expm232
+            - He_molg
+            )
+        
+        slope = (
+            lambda238*ageterm_238*(expm238+1) 
+            + lambda235*ageterm_235*(expm235+1)
+            + lambda232*ageterm_232*(expm232+1)
+            )
+        
+        t = t - root/slope
+    
+    age_Ma = t/1e6
+    
+    return(age_Ma)
+
 def alpha_correction(stopping_distance,radius):
     """
     Calculate alpha ejection correction factor, after Ketcham et al., 2011.
@@ -464,8 +648,247 @@ def model_alpha_ejection(node_positions,stopping_distance,radius):
     
     return(retained_fractions_edge)
 
+def alpha_He_production(node_positions,radius,UTh_molg,stop_distances):
+    """
+    Calculate He production rate at each node, with U and Th adjusted for
+    alpha ejection after Ketcham et al., 2011.
+
+    Parameters
+    ----------
+    node_positions : NumPy array
+        Radial positions of each modeled node (um)
+    radius : float
+        Radius of the grain (um)
+    UTh_molg : tuple
+        U238, U235, and Th232 (mol/g)
+    stop_distances : NumPy array
+        Stopping distances (um) for U238, U235, and Th232.
+
+    Returns
+    -------
+    He_production : NumPy array
+        He production (mol/g) at each node
+
+    """
+    U238_molg,U235_molg,Th_molg = UTh_molg
+    
+    # Modify mol/g of U,Th for alpha ejection
+    U238_alpha = (
+        U238_molg*model_alpha_ejection(node_positions,stop_distances[0],
+                                                radius)
+        )
+    
+    U235_alpha = (
+        U235_molg*model_alpha_ejection(node_positions,stop_distances[1],
+                                                radius)
+        )
+    
+    Th_alpha = (
+        Th_molg*model_alpha_ejection(node_positions,stop_distances[2],
+                                                radius)
+        )
+    
+    He_production = calculate_He_production_rate(U238_alpha,U235_alpha,Th_alpha)
+    
+    return(He_production)
+
+@functools.lru_cache(maxsize=32)
+def grain_setup(U,Th,radius,system,nodes,K=None):
+    """
+    Precompute grain geometry, system parameters, and production for a 
+    grain. For He systems, production accounts for alpha ejection. For Ar
+    systems, production is uniform and depends only on K.
+    
+    Results are cached on the arguments, so repeated forward models of the 
+    same grain (e.g. every particle and timestep in He_age_vtk_parallel)
+    reuse them. Returned arrays are read-only.
+
+    Parameters
+    ----------
+    U : float
+        U concentration (ppm)
+    Th : float
+        Th concentration (ppm)
+    radius : float
+        Radius of the grain (um)
+    system : string
+        Isotopic system. Options include AHe, ZHe, BtAr, MsAr, HbAr, and 
+        KsAr.
+    nodes : int
+        Number of nodes to model within the crystal.
+    K : float, optional
+        K concentration (wt%). Required for Ar systems. The default is None.
+
+    Returns
+    -------
+    node_information : tuple
+        Number of nodes, node spacing (um), and node positions (um).
+    UTh_molg : tuple
+        U238, U235, and Th232 (mol/g), or K40 (mol/g) for Ar systems.
+    system_parameters : tuple
+        Frequency factor, activation energy, and stopping distances (None 
+        for Ar systems).
+    He_production : NumPy array
+        He (or Ar40) production (mol/g) at each node
+
+    """
+    # Find node spacing based on radius
+    node_spacing = radius/nodes
+    
+    node_positions = calculate_node_positions(node_spacing,radius)
+    
+    # Get parameters for the appropriate mineral
+    parameters = get_parameters(system)
+    
+    if len(parameters) == 3:
+        freq_factor,activ_energy,stop_distances = parameters
+    
+        # Get mol/g of U,Th
+        U238_molg,U235_molg,Th_molg = UTh_ppm2molg(U,Th)
+        UTh_molg = (U238_molg,U235_molg,Th_molg)
+        
+        He_production = alpha_He_production(node_positions,radius,UTh_molg,
+                                            stop_distances)
+        stop_distances.flags.writeable = False
+    
+    else:
+        freq_factor,activ_energy = parameters
+        stop_distances = None
+        
+        if K is None:
+            raise Exception('K concentration required for Ar systems')
+        
+        # No alpha ejection, so Ar40 production is uniform
+        K40_molg = K_wt2molg(K)
+        UTh_molg = (K40_molg,)
+        
+        He_production = np.full(len(node_positions),
+                                calculate_Ar_production_rate(K40_molg))
+    
+    # Package parameters to pass to He profile
+    node_information = (nodes,node_spacing,node_positions)
+    system_parameters = (freq_factor,activ_energy,stop_distances)
+    
+    for array in (node_positions,He_production):
+        array.flags.writeable = False
+    
+    return(node_information,UTh_molg,system_parameters,He_production)
+
+@functools.lru_cache(maxsize=OPERATOR_CACHE_SIZE)
+def factorize_diffusion_step(temp,time_interval,node_spacing,nodes,
+                             freq_factor,activ_energy):
+    """
+    LU-factorize the tridiagonal matrix A for one temperature step of the
+    finite difference scheme, after Ketcham, 2005.
+    
+    Results are held in a bounded LRU cache keyed on the arguments, so 
+    steps at a repeated temperature reuse the factorization. Pass 
+    temperatures through quantize_temperature to increase reuse.
+
+    Parameters
+    ----------
+    temp : float
+        Temperature (K)
+    time_interval : float
+        Timestep in the thermal model (yr)
+    node_spacing : float
+        Distance between nodes in the crystal (um)
+    nodes : int
+        Number of modeled nodes in the crystal
+    freq_factor : float
+        Frequency factor (um^2*yr^-1)
+    activ_energy : float
+        Activation energy (J*mol^-1)
+
+    Returns
+    -------
+    beta : float
+        Beta, after Ketcham, 2005.
+    factors : tuple
+        LAPACK gttrf factorization of A, for use with lapack.dgttrs.
+
+    """
+    diffusivity = calculate_diffusivity(temp,freq_factor,activ_energy)
+    beta = calculate_beta(diffusivity,node_spacing,time_interval)
+    
+    # Principal diagonal, with Neumann condition on first node
+    diagonal = np.full(nodes,-2-beta)
+    diagonal[0] = -3-beta
+    off_diagonal = np.ones(nodes-1)
+    
+    dl,d,du,du2,ipiv,info = lapack.dgttrf(off_diagonal,diagonal,off_diagonal)
+    
+    factors = (dl,d,du,du2,ipiv)
+    for array in factors:
+        array.flags.writeable = False
+    
+    return(beta,factors)
+
+def clear_operator_cache():
+    """
+    Clear cached grain setups and factorized diffusion steps.
+    """
+    grain_setup.cache_clear()
+    factorize_diffusion_step.cache_clear()
+
+def quantize_temperature(temps,temp_resolution=None):
+    """
+    Round temperatures to a fixed resolution so that nearly identical
+    temperatures share cached diffusion steps.
+
+    Parameters
+    ----------
+    temps : NumPy array
+        Temperatures (K)
+    temp_resolution : float, optional
+        Resolution (K) to round to. The default is None, which leaves 
+        temperatures unchanged.
+
+    Returns
+    -------
+    temps : NumPy array
+        Temperatures (K) as float64
+
+    """
+    temps = np.asarray(temps,dtype=np.float64)
+    
+    if temp_resolution is not None:
+        temps = np.round(temps/temp_resolution)*temp_resolution
+    
+    return(temps)
+
+def diffusion_rhs(x,beta,production_term):
+    """
+    Calculate B for the finite difference scheme of Ketcham, 2005, using a
+    Neumann condition at the first node and a Dirichlet condition at the 
+    last node.
+
+    Parameters
+    ----------
+    x : NumPy array
+        Current x, with nodes along the first axis.
+    beta : float or NumPy array
+        Beta for the step (one value per column of x).
+    production_term : NumPy array
+        He production times node position times time interval, with nodes
+        along the first axis.
+
+    Returns
+    -------
+    B : NumPy array
+        B with the same shape as x.
+
+    """
+    B = (2-beta)*x - production_term*beta
+    B[1:] -= x[:-1]
+    B[:-1] -= x[1:]
+    B[0] += x[0]
+    
+    return(B)
+
 def forward_model(U,Th,radius,temps,time_interval,system,nodes=513,
-                  initial_He=np.nan,calc_age=True,print_age=True):
+                  initial_He=np.nan,calc_age=True,print_age=True,
+                  temp_resolution=None,backend='numpy',K=None):
     """
     Forward model a (U-Th)/He age for a particular time-temperature path.
     
@@ -486,9 +909,21 @@ def forward_model(U,Th,radius,temps,time_interval,system,nodes=513,
     time_interval : float
         Time (yr) between each temperature in the time-temperature path.
     system : string
-        Isotopic system. Current options are 'AHe' and 'ZHe'.
+        Isotopic system. Options are 'AHe', 'ZHe', and the Ar systems 
+        'BtAr', 'MsAr', 'HbAr', and 'KsAr' (which require K).
     nodes : float, optional
         Number of nodes to model within the crystal. The default is 513.
+        Any number of nodes can be used; fewer nodes trade accuracy for 
+        memory and speed (see tests/Ketcham05_nodes.py).
+    temp_resolution : float, optional
+        Resolution (K) to round temperatures to, so that cached diffusion 
+        steps are reused. The default is None (no rounding).
+    backend : string, optional
+        Backend for the T-t integration. Options are 'numpy' and 'numba' 
+        (JIT-compiled, falls back to 'numpy' if Numba is not installed).
+        The default is 'numpy'.
+    K : float, optional
+        K concentration (wt%) for Ar systems. The default is None.
 
     Returns
     -------
@@ -497,26 +932,17 @@ def forward_model(U,Th,radius,temps,time_interval,system,nodes=513,
 
     """
     
-    # Find node spacing and time interval based on radius and T-t path
-    node_spacing = radius/nodes
-    
-    node_positions = calculate_node_positions(node_spacing,radius)
-    
-    # Get parameters for the appropriate mineral
-    freq_factor,activ_energy,stop_distances = get_parameters(system)
-    
-    # Get mol/g of U,Th
-    U238_molg,U235_molg,Th_molg = UTh_ppm2molg(U,Th)
-    
-    # Package parameters to pass to He profile
-    
-    node_information = (nodes,node_spacing,node_positions)
-    UTh_molg = (U238_molg,U235_molg,Th_molg)
-    system_parameters = (freq_factor,activ_energy,stop_distances)
+    # Get (cached) grain geometry, parameters, and He production
+    node_information,UTh_molg,system_parameters,He_production = (
+        grain_setup(U,Th,radius,system,nodes,K)
+        )
+    node_positions = node_information[2]
+    stop_distances = system_parameters[2]
     
     # Calculate He profile
     x = He_profile(temps,time_interval,node_information,radius,UTh_molg,
-                   system_parameters,initial_He)
+                   system_parameters,initial_He,He_production,
+                   temp_resolution,backend)
     
     if calc_age==True:
     
@@ -530,77 +956,336 @@ def forward_model(U,Th,radius,temps,time_interval,system,nodes=513,
         return(x)
 
 def He_profile(temps,time_interval,node_information,radius,UTh_molg,
-               system_parameters,initial_He=np.nan):    
+               system_parameters,initial_He=np.nan,He_production=None,
+               temp_resolution=None,backend='numpy'):    
     
     # Unpack parameters
     nodes,node_spacing,node_positions = node_information
-    U238_molg,U235_molg,Th_molg = UTh_molg
     freq_factor,activ_energy,stop_distances = system_parameters
 
-    # Modify mol/g of U,Th for alpha ejection
-    U238_alpha = (
-        U238_molg*model_alpha_ejection(node_positions,stop_distances[0],
-                                                radius)
-        )
-    
-    U235_alpha = (
-        U235_molg*model_alpha_ejection(node_positions,stop_distances[1],
-                                                radius)
-        )
-    
-    Th_alpha = (
-        Th_molg*model_alpha_ejection(node_positions,stop_distances[2],
-                                                radius)
-        )
-    
     # Calculate He production based on U and Th, adjusted for alpha ejection.
-    He_production = calculate_He_production_rate(U238_alpha,U235_alpha,Th_alpha)
+    if He_production is None:
+        He_production = alpha_He_production(node_positions,radius,UTh_molg,
+                                            stop_distances)
     
     if np.all(np.isnan(initial_He)):
         # Set initial x (He) equal to 0
         x = np.zeros(nodes)
     else:
-        x = initial_He
+        x = np.array(initial_He,dtype=np.float64)
+    
+    production_term = He_production*node_positions*time_interval
+    
+    temps = quantize_temperature(temps,temp_resolution)
+    
+    if backend == 'numba':
+        if numba is None:
+            warnings.warn('Numba not installed, using numpy backend')
+        else:
+            x = He_profile_jit(temps,time_interval,node_spacing,
+                               production_term,freq_factor,activ_energy,x)
+            return(x)
+    
+    elif backend != 'numpy':
+        raise Exception('Backend Not Found')
     
     # Loop through each step of the T-t path
     
     for temp in temps:
         
-        # Use temperature to calculate diffusivity and beta
+        # Use temperature to get beta and (cached) factorized A
+        beta,factors = factorize_diffusion_step(float(temp),time_interval,
+                                                node_spacing,nodes,
+                                                freq_factor,activ_energy)
         
-        diffusivity = calculate_diffusivity(temp,freq_factor,activ_energy)
-        beta = calculate_beta(diffusivity,node_spacing, time_interval)
+        # Use x to calculate new B
+        B = diffusion_rhs(x,beta,production_term)
         
-       # Calculate A (banded) and use x to calculate new B
-
-        AB = tridiag_banded(1,-2-beta,1,nodes)
-        AB[1,0]=-3-beta # Following Guenthner Matlab script - Neumann
-        B = np.zeros(nodes)
-        # Loop through each node
-        for j in range(len(node_positions)):
-            # For first node, use boundary condition (Neumann)
-            if j==0:
-                B[j] = (
-                    x[j] + (2-beta)*x[j] - x[j+1]
-                    - He_production[j]*node_positions[j]*beta*time_interval
-                    )
-                
-            # For last node, use boundary condition (Drichlet)
-            elif j==(len(B)-1):
-                B[j] = (
-                    -x[j-1] + (2-beta)*x[j] - 0
-                    - He_production[j]*node_positions[j]*beta*time_interval
-                    )
-            # Use previous and subsequent nodes for remaining nodes
+        # Solve for x using factorized A and B
+        x,info = lapack.dgttrs(*factors,B[:,None])
+        x = x[:,0]
+        
+    return(x)
+
+def He_profile_kernel(temps,time_interval,node_spacing,production_term,
+                      freq_factor,activ_energy,x,R=8.3144598):
+    """
+    Loop-based T-t integration for a single grain, for JIT compilation 
+    with Numba.
+    
+    Same finite difference scheme as He_profile, with B built node by node 
+    and A solved with the Thomas algorithm. x is updated in place.
+
+    Parameters
+    ----------
+    temps : NumPy array
+        List of temperatures (K) for the time-temperature path
+    time_interval : float
+        Time (yr) between each temperature in the time-temperature path.
+    node_spacing : float
+        Distance between nodes in the crystal (um)
+    production_term : NumPy array
+        He production times node position times time interval.
+    freq_factor : float
+        Frequency factor (um^2*yr^-1)
+    activ_energy : float
+        Activation energy (J*mol^-1)
+    x : NumPy array
+        Initial x (float64)
+    R : float, optional
+        Gas constant (J*K^-1*mol^-1). The default is 8.3144598.
+
+    Returns
+    -------
+    x : NumPy array
+        Final x
+
+    """
+    nodes = x.size
+    B = np.empty(nodes)
+    c_prime = np.empty(nodes)
+    
+    for n in range(temps.size):
+        
+        # Use temperature to calculate diffusivity and beta
+        diffusivity = freq_factor*np.exp(-activ_energy/(R*temps[n]))
+        beta = (2*(node_spacing**2))/(diffusivity*time_interval)
+        
+        # Calculate B, with Neumann (first) and Dirichlet (last) nodes
+        for j in range(nodes):
+            B[j] = (2-beta)*x[j] - production_term[j]*beta
+            if j == 0:
+                B[j] += x[j]
             else:
-                B[j] = (
-                    -x[j-1] + (2-beta)*x[j] - x[j+1]
-                    - He_production[j]*node_positions[j]*beta*time_interval
-                    )
+                B[j] -= x[j-1]
+            if j < nodes-1:
+                B[j] -= x[j+1]
+        
+        # Forward sweep, storing d' in x
+        c_prime[0] = 1/(-3-beta)
+        x[0] = B[0]*c_prime[0]
+        for j in range(1,nodes):
+            c_prime[j] = 1/(-2-beta-c_prime[j-1])
+            x[j] = (B[j]-x[j-1])*c_prime[j]
+        
+        # Back substitution
+        for j in range(nodes-2,-1,-1):
+            x[j] -= c_prime[j]*x[j+1]
+    
+    return(x)
+
+if numba is not None:
+    He_profile_jit = numba.njit(cache=True)(He_profile_kernel)
+else:
+    He_profile_jit = None
+
+def forward_model_batch(U,Th,radius,temps,time_interval,system,nodes=513,
+                        initial_He=np.nan,calc_age=True,temp_resolution=None,
+                        K=None):
+    """
+    Forward model (U-Th)/He ages for many time-temperature paths at once.
+    
+    Equivalent to calling forward_model for each row of temps, but advances
+    the He profiles of all particles together using a vectorized tridiagonal
+    (Thomas) solve instead of one solve_banded call per particle.
+
+    Parameters
+    ----------
+    U : float
+        U concentration (ppm)
+    Th : float
+        Th concentration (ppm)
+    radius : float
+        Radius of the grain (um)
+    temps : NumPy array
+        Temperatures (K) with shape (n_particles, n_steps)
+    time_interval : float
+        Time (yr) between each temperature in the time-temperature paths.
+    system : string
+        Isotopic system. Options are 'AHe', 'ZHe', and the Ar systems 
+        'BtAr', 'MsAr', 'HbAr', and 'KsAr' (which require K).
+    nodes : float, optional
+        Number of nodes to model within the crystal. The default is 513.
+        Any number of nodes can be used; fewer nodes trade accuracy for 
+        memory and speed (see tests/Ketcham05_nodes.py).
+    initial_He : NumPy array, optional
+        Initial profiles with shape (n_particles, nodes). Rows that are all
+        np.nan start with no He. The default is np.nan.
+    calc_age : bool, optional
+        Whether to calculate ages from the final profiles. The default is 
+        True.
+    temp_resolution : float, optional
+        If given, temperatures are rounded to this resolution (K) and 
+        particles sharing a temperature are solved together with a cached
+        factorization. The default is None (exact temperatures, vectorized
+        Thomas solve).
+    K : float, optional
+        K concentration (wt%) for Ar systems. The default is None.
+
+    Returns
+    -------
+    ages : NumPy array
+        (U-Th)/He ages (Ma) corrected for alpha ejection. Only returned if
+        calc_age is True.
+    x : NumPy array
+        Final He profiles with shape (n_particles, nodes)
+
+    """
+    
+    # Get (cached) grain geometry, parameters, and He production
+    node_information,UTh_molg,system_parameters,He_production = (
+        grain_setup(U,Th,radius,system,nodes,K)
+        )
+    node_positions = node_information[2]
+    stop_distances = system_parameters[2]
+    
+    # Calculate He profiles
+    x = He_profile_batch(temps,time_interval,node_information,radius,
+                         UTh_molg,system_parameters,initial_He,He_production,
+                         temp_resolution)
+    
+    if calc_age==True:
+        
+        ages,ages_uncorrected = profiles2ages(x,node_positions,radius,
+                                              UTh_molg,stop_distances)
+        
+        return(ages,x)
+    
+    else:
+        return(x)
+
+def He_profile_batch(temps,time_interval,node_information,radius,UTh_molg,
+                     system_parameters,initial_He=np.nan,He_production=None,
+                     temp_resolution=None):
+    """
+    Calculate He profiles for many particles at once, after Ketcham, 2005.
+    
+    Uses the same finite difference scheme and boundary conditions as 
+    He_profile, with the nodes of every particle solved together.
+
+    Parameters
+    ----------
+    temps : NumPy array
+        Temperatures (K) with shape (n_particles, n_steps)
+    time_interval : float
+        Time (yr) between each temperature in the time-temperature paths.
+    node_information : tuple
+        Number of nodes, node spacing (um), and node positions (um).
+    radius : float
+        Radius of the grain (um)
+    UTh_molg : tuple
+        U238, U235, and Th232 (mol/g)
+    system_parameters : tuple
+        Frequency factor, activation energy, and stopping distances.
+    initial_He : NumPy array, optional
+        Initial profiles with shape (n_particles, nodes). Rows that are all
+        np.nan start with no He. The default is np.nan.
+    He_production : NumPy array, optional
+        Precomputed He production at each node. The default is None.
+    temp_resolution : float, optional
+        Resolution (K) to round temperatures to before grouping particles
+        by temperature. The default is None (no grouping).
+
+    Returns
+    -------
+    x : NumPy array
+        He profiles with shape (n_particles, nodes)
+
+    """
+    
+    # Unpack parameters
+    nodes,node_spacing,node_positions = node_information
+    freq_factor,activ_energy,stop_distances = system_parameters
+    
+    temps = quantize_temperature(temps,temp_resolution)
+    n_particles = temps.shape[0]
+    
+    if He_production is None:
+        He_production = alpha_He_production(node_positions,radius,UTh_molg,
+                                            stop_distances)
+    
+    # Work with nodes along the first axis so each sweep step is contiguous
+    if np.all(np.isnan(initial_He)):
+        x = np.zeros((nodes,n_particles))
+    else:
+        x = np.array(np.broadcast_to(initial_He,(n_particles,nodes)).T,
+                     dtype=np.float64)
+        x[:,np.isnan(x).all(axis=0)] = 0
+    
+    production_term = (He_production*node_positions)[:,None]*time_interval
+    
+    for temp in temps.T:
         
-        # Solve for x using banded A and B
-        x = solve_banded((1,1),AB,B)
+        if temp_resolution is None:
+            
+            # Use temperature to calculate diffusivity and beta
+            diffusivity = calculate_diffusivity(temp,freq_factor,activ_energy)
+            beta = calculate_beta(diffusivity,node_spacing,time_interval)
+            
+            # Principal diagonal of A, with Neumann condition on first node
+            diagonal = np.broadcast_to(-2-beta,(nodes,n_particles)).copy()
+            diagonal[0] = -3-beta
+            
+            B = diffusion_rhs(x,beta,production_term)
+            
+            x = solve_tridiag_batch(diagonal,B)
         
+        else:
+            
+            # Group particles by temperature and get (cached) factorized A
+            unique_temps,inverse,counts = np.unique(temp,return_inverse=True,
+                                                    return_counts=True)
+            steps = [factorize_diffusion_step(float(unique_temp),
+                                              time_interval,node_spacing,
+                                              nodes,freq_factor,activ_energy)
+                     for unique_temp in unique_temps]
+            
+            betas = np.array([beta for beta,factors in steps])
+            B = diffusion_rhs(x,betas[inverse],production_term)
+            
+            # Solve all particles sharing a temperature together
+            order = np.argsort(inverse,kind='stable')
+            groups = np.split(order,np.cumsum(counts)[:-1])
+            for (beta,factors),group in zip(steps,groups):
+                x[:,group],info = lapack.dgttrs(*factors,B[:,group])
+    
+    return(x.T)
+
+def solve_tridiag_batch(diagonal,B):
+    """
+    Solve many tridiagonal systems with off-diagonals of 1 using the Thomas 
+    algorithm, vectorized across systems.
+
+    Parameters
+    ----------
+    diagonal : NumPy array
+        Principal diagonals with shape (nodes, n_systems)
+    B : NumPy array
+        Right-hand sides with shape (nodes, n_systems)
+
+    Returns
+    -------
+    x : NumPy array
+        Solutions with shape (nodes, n_systems)
+
+    """
+    nodes = len(B)
+    
+    c_prime = np.empty_like(B)
+    d_prime = np.empty_like(B)
+    
+    # Forward sweep
+    c_prime[0] = 1/diagonal[0]
+    d_prime[0] = B[0]*c_prime[0]
+    for j in range(1,nodes):
+        c_prime[j] = 1/(diagonal[j]-c_prime[j-1])
+        d_prime[j] = (B[j]-d_prime[j-1])*c_prime[j]
+    
+    # Back substitution
+    x = d_prime
+    for j in range(nodes-2,-1,-1):
+        x[j] -= c_prime[j]*x[j+1]
+    
     return(x)
 
 def profile2age(x,node_positions,radius,nodes,UTh_molg,stop_distances,
@@ -609,6 +1294,18 @@ def profile2age(x,node_positions,radius,nodes,UTh_molg,stop_distances,
     He_molg,volumes = sum_He_shells(x,node_positions,radius,nodes,
                                     print_He=print_age)
     
+    # Ar systems have no alpha ejection, so use K-Ar age directly
+    if stop_distances is None:
+        age_corrected = calculate_Ar_ages(He_molg,UTh_molg[0])
+        
+        if print_age==True:
+            print('Age (Ma): ',age_corrected)
+        
+        volumes_normalized = volumes/np.max(volumes)
+        position_normalized = node_positions/radius
+        
+        return(age_corrected,volumes_normalized,position_normalized)
+    
     U238_molg,U235_molg,Th_molg = UTh_molg
     
     # Because alpha ejection modeled, model age is an "uncorrected" age.
@@ -636,6 +1333,64 @@ def profile2age(x,node_positions,radius,nodes,UTh_molg,stop_distances,
     
     return(age_corrected,volumes_normalized,position_normalized)
 
+def profiles2ages(x,node_positions,radius,UTh_molg,stop_distances):
+    """
+    Calculate corrected and uncorrected ages for many He profiles at once.
+    
+    Vectorized equivalent of profile2age, using calculate_ages in place of 
+    calculate_age.
+
+    Parameters
+    ----------
+    x : NumPy array
+        He profiles with shape (n_particles, nodes)
+    node_positions : NumPy array
+        Radial positions of each modeled node (um)
+    radius : float
+        Radius of the grain (um)
+    UTh_molg : tuple
+        U238, U235, and Th232 (mol/g), or K40 (mol/g) for Ar systems.
+    stop_distances : NumPy array
+        Stopping distances (um) for U238, U235, and Th232, or None for Ar
+        systems.
+
+    Returns
+    -------
+    age_corrected : NumPy array
+        (U-Th)/He ages (Ma) corrected for alpha ejection
+    age_uncorrected : NumPy array
+        (U-Th)/He ages (Ma) without alpha correction
+
+    """
+    # Back-substitute u=vr to get radial profiles
+    v = x/node_positions
+    
+    # Get shell volumes as fraction of total volume
+    sphere_volumes = (node_positions)**3 * (4*np.pi/3)
+    total_volume = radius**3 * (4*np.pi/3)
+    shell_fraction = np.diff(sphere_volumes,prepend=0)/total_volume
+    
+    # Integrate weighted radial profiles
+    He_molg = integrate_shells(v*shell_fraction)
+    
+    # Ar systems have no alpha ejection, so use K-Ar age for both
+    if stop_distances is None:
+        age = calculate_Ar_ages(He_molg,UTh_molg[0])
+        return(age,age)
+    
+    U238_molg,U235_molg,Th_molg = UTh_molg
+    
+    # Because alpha ejection modeled, model age is an "uncorrected" age.
+    age_uncorrected = calculate_ages(He_molg,U238_molg,U235_molg,Th_molg)
+    
+    # "Corrected" age uses alpha-adjusted U-Th values
+    tau = alpha_correction(stop_distances,radius)
+    
+    age_corrected = calculate_ages(He_molg,U238_molg*tau[0],U235_molg*tau[1],
+                                   Th_molg*tau[2])
+    
+    return(age_corrected,age_uncorrected)
+
 def interpolate(x,y,age,**kwargs):
     all_parts = (x,y)
     
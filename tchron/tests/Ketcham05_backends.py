@@ -0,0 +1,42 @@
+"""
+Compare ages from the numpy and numba backends for the Ketcham, 2005 tests.
+"""
+import time
+
+import numpy as np
+from tchron import tchron as tc
+
+U = 100
+Th = 100
+radius = 100
+time_interval = 1e5
+
+# Ketcham, 2005 tests 1-3
+early_t = np.linspace(120,20,101)
+late_t = np.linspace(20,20,500)
+temps_1 = np.append(early_t,late_t) + 273
+
+temps_2 = np.linspace(120,20,601) + 273
+
+early_t = np.linspace(120,65,576) + 273
+late_t = np.linspace(65,20,26)+273
+temps_3 = np.append(early_t,late_t[1:])
+
+ages_ketcham = [54.6,26.5,7.12]
+
+for n,temps in enumerate([temps_1,temps_2,temps_3]):
+    
+    ages = []
+    for backend in ['numpy','numba']:
+        start = time.time()
+        age,volumes,positions,x = tc.forward_model(U,Th,radius,temps,
+                                                   time_interval,system='AHe',
+                                                   print_age=False,
+                                                   backend=backend)
+        ages.append(age)
+        print('Test '+str(n+1)+' ('+backend+'): '+str(round(age,4))+' Ma, '
+              + str(round(time.time()-start,3))+' s')
+    
+    print('Ketcham, 2005: '+str(ages_ketcham[n])+' Ma')
+    
+    assert np.isclose(ages[0],ages[1],rtol=1e-9)
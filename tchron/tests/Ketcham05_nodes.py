@@ -0,0 +1,37 @@
+"""
+Accuracy of reduced node counts against the 513-node reference for the 
+Ketcham, 2005 tests.
+"""
+import numpy as np
+from tchron import tchron as tc
+
+U = 100
+Th = 100
+radius = 100
+time_interval = 1e5
+
+# Ketcham, 2005 tests 1-3
+early_t = np.linspace(120,20,101)
+late_t = np.linspace(20,20,500)
+temps_1 = np.append(early_t,late_t) + 273
+
+temps_2 = np.linspace(120,20,601) + 273
+
+early_t = np.linspace(120,65,576) + 273
+late_t = np.linspace(65,20,26)+273
+temps_3 = np.append(early_t,late_t[1:])
+
+temps = np.vstack([temps_1,temps_2,temps_3])
+
+ages_ref,x = tc.forward_model_batch(U,Th,radius,temps,time_interval,'AHe',
+                                    nodes=513)
+
+print('Reference (513 nodes): ',np.round(ages_ref,4),'Ma')
+print('Nodes  Age difference (%) for tests 1-3')
+
+for nodes in [400,257,200,129,100,65,50]:
+    ages,x = tc.forward_model_batch(U,Th,radius,temps,time_interval,'AHe',
+                                    nodes=nodes)
+    
+    difference = (ages-ages_ref)/ages_ref*100
+    print(str(nodes).rjust(5),' ',np.round(difference,3))
@@ -0,0 +1,32 @@
+"""
+Test matching of particle ids with vtk_plot.match_ids, including ids that
+are duplicated or missing.
+"""
+import numpy as np
+
+import vtk_plot as vp
+
+ids = np.array([7,3,9,3,1])
+
+# Present ids, with duplicates matched to their first occurrence
+rows = vp.match_ids(ids,np.array([9,3,1,7]))
+assert np.array_equal(rows,[2,1,4,0])
+
+# Missing ids, including ids above and below every stored id
+rows = vp.match_ids(ids,np.array([0,3,5,10]))
+assert np.array_equal(rows,[-1,1,-1,-1])
+
+# Missing ids must not index the last row
+values = np.array([70.,30.,90.,31.,10.])
+matched = np.where(rows>=0,values[rows],np.nan)
+assert np.isnan(matched[[0,2,3]]).all() and matched[1]==30.
+
+# Single id and empty ids
+assert vp.match_ids(ids,9)==2
+assert vp.match_ids(np.array([],dtype=int),np.array([1,2])).tolist()==[-1,-1]
+
+# Reused sorter
+sorter = np.argsort(ids,kind='stable')
+assert np.array_equal(vp.match_ids(ids,np.array([1,4]),sorter=sorter),[4,-1])
+
+print('match_ids tests passed')
@@ -0,0 +1,70 @@
+"""
+Test that particle arrays loaded through shared memory stay valid after
+the containers they came in are dropped, and that no shared memory is left
+behind when a file is missing.
+"""
+import os
+import gc
+
+import numpy as np
+
+import vtk_plot as vp
+
+files_dir = '../../sample_data/vtk_tchron_test/'
+files = [os.path.join(files_dir,'vtk_tchron_test_'+str(k)+'.vtu') 
+         for k in range(3)]
+
+meshes = vp.load_particle_meshes(files,None,save=False,parallel=False)
+ids_ref,temps_ref,positions_ref = vp.extract_temps_positions(meshes)
+
+# Keep only the extracted arrays, then drop the loaded dictionaries
+arrays = vp.load_particle_arrays(files,None,processes=2)
+ids,temps,positions = vp.extract_temps_positions(arrays)
+del arrays
+gc.collect()
+
+for k in range(len(files)):
+    assert np.array_equal(ids[k],ids_ref[k])
+    assert np.array_equal(temps[k],temps_ref[k])
+    assert np.array_equal(positions[k],positions_ref[k])
+
+# Keep only one array from a single file
+info = vp.read_shared_arrays(files[0])
+temps_0 = vp.attach_shared_arrays(info)['T']
+gc.collect()
+assert np.array_equal(temps_0,temps_ref[0])
+
+#%% Missing file: the load fails and frees all shared memory
+def count_segments():
+    return(len([name for name in os.listdir('/dev/shm') 
+                if name.startswith('rp')]))
+
+files_all = [os.path.join(files_dir,'vtk_tchron_test_'+str(k)+'.vtu') 
+             for k in range(21)]
+files_missing = files_all[:10] + ['missing.vtu'] + files_all[10:]
+
+if os.path.isdir('/dev/shm'):
+    segments = count_segments()
+    
+    try:
+        vp.load_particle_arrays(files_missing,None,processes=3)
+    except FileNotFoundError:
+        pass
+    else:
+        raise AssertionError('Missing file did not raise')
+    
+    assert count_segments()==segments
+    
+    if vp.pa is not None:
+        try:
+            vp.build_particle_store(files_missing,np.arange(22),
+                                    'missing.parquet',processes=3)
+        except FileNotFoundError:
+            pass
+        else:
+            raise AssertionError('Missing file did not raise')
+        
+        assert count_segments()==segments
+        os.remove('missing.parquet')
+
+print('shared arrays tests passed')
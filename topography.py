@@ -0,0 +1,256 @@
+"""
+Functions for reading ASPECT topography output.
+"""
+import os
+import re
+import hashlib
+
+import numpy as np
+import pandas as pd
+from tqdm import tqdm
+
+# Directory for parsed topography saved by Topography. Each output directory
+# has one .npy/.npz pair, replaced when its topography files change. The 
+# directory can be deleted at any time to clean up.
+TOPOGRAPHY_CACHE_DIR = os.path.expanduser('~/.cache/riftinversion/topography')
+
+def scan_topography(directory):
+    """
+    Find topography files in an ASPECT output directory.
+
+    ASPECT names topography files topography.NNNNN, where NNNNN is the
+    model time step number.
+
+    Parameters
+    ----------
+    directory: ASPECT output directory
+
+    Returns
+    -------
+    files: Dictionary of file paths, keyed by time step number and sorted
+        by time step.
+    """
+    pattern = re.compile(r'topography\.(\d+)$')
+
+    files = {}
+    with os.scandir(directory) as entries:
+        for entry in entries:
+            match = pattern.match(entry.name)
+            if match and entry.is_file():
+                files[int(match.group(1))] = entry.path
+
+    files = dict(sorted(files.items()))
+
+    return(files)
+
+def read_statistics_times(directory):
+    """
+    Get model time of each time step from an ASPECT statistics file.
+
+    Parameters
+    ----------
+    directory: ASPECT output directory
+
+    Returns
+    -------
+    times: Dictionary of model times (years), keyed by time step number,
+        or None if there is no statistics file.
+    """
+    file = os.path.join(directory,'statistics')
+
+    if not os.path.exists(file):
+        return(None)
+
+    # Find columns from the header
+    columns = {}
+    with open(file) as f:
+        for line in f:
+            if not line.startswith('#'):
+                break
+            match = re.match(r'#\s*(\d+):\s*(.*)',line)
+            if match:
+                columns[match.group(2).strip()] = int(match.group(1))-1
+
+    step_col = columns['Time step number']
+    time_col = columns['Time (years)']
+
+    stats = pd.read_csv(file,sep=r'\s+',comment='#',header=None,
+                        usecols=[step_col,time_col])
+
+    # Keep the last row of each step, in case of restarts
+    times = dict(zip(stats[step_col].astype(int),stats[time_col]))
+
+    return(times)
+
+def read_topography_file(file):
+    """
+    Read an ASPECT topography file.
+
+    Returns
+    -------
+    topo: NumPy array of surface X and Y positions (columns), sorted by X.
+    """
+    topo = pd.read_csv(file,delimiter=' ',header=None,skiprows=1,
+                       usecols=[0,1]).values
+
+    # Sort by X for interpolation
+    topo = topo[np.argsort(topo[:,0],kind='stable')]
+
+    return(topo)
+
+class Topography:
+    """
+    Topography snapshots of an ASPECT model, indexed by time step number 
+    or model time.
+
+    The output directory is scanned once. Single snapshots (e.g. last) are 
+    read straight from their files until load is called, which parses every
+    snapshot into one array of surface points and, if cache_dir is set, 
+    saves it as .npy. Later instances reload (memory-map) the saved array 
+    as long as the topography files are unchanged. Each snapshot keeps its
+    own X positions, since adaptive refinement moves the surface nodes.
+
+    Parameters
+    ----------
+    directory: ASPECT output directory
+    cache_dir: Directory to save parsed topography in, True to use 
+        TOPOGRAPHY_CACHE_DIR, or None to not save it. The default is True.
+    disable_tqdm: Whether to disable the progress bar when parsing files.
+
+    Attributes
+    ----------
+    steps: NumPy array of time step numbers of each snapshot.
+    times: NumPy array of model time (years) of each snapshot, or None if
+        there is no statistics file.
+    points: NumPy array of surface X and Y positions of all snapshots, one
+        after the other, or None until loaded.
+    offsets: NumPy array of the first row of points of each snapshot, and
+        the total number of rows, or None until loaded.
+    """
+    def __init__(self,directory,cache_dir=True,disable_tqdm=True):
+        self.directory = directory
+        self.disable_tqdm = disable_tqdm
+
+        self.files = scan_topography(directory)
+
+        if len(self.files)==0:
+            raise Exception('No topography files in '+directory)
+
+        self.steps = np.array(list(self.files.keys()))
+
+        self.points = None
+        self.offsets = None
+
+        if cache_dir is True:
+            cache_dir = TOPOGRAPHY_CACHE_DIR
+
+        # Key cache by directory and file names, sizes, and times
+        if cache_dir is not None:
+            sha = hashlib.sha1(os.path.abspath(directory).encode())
+            dir_key = sha.hexdigest()
+            for path in self.files.values():
+                stat = os.stat(path)
+                sha.update((os.path.basename(path)+str(stat.st_size)+
+                            str(stat.st_mtime_ns)).encode())
+            self.key = sha.hexdigest()
+
+            self.points_path = os.path.join(cache_dir,dir_key+'_points.npy')
+            self.index_path = os.path.join(cache_dir,dir_key+'_index.npz')
+
+            if (os.path.exists(self.index_path) and 
+                os.path.exists(self.points_path)):
+                with np.load(self.index_path) as index:
+                    if str(index['key'])==self.key:
+                        self.offsets = index['offsets']
+                        self.points = np.load(self.points_path,mmap_mode='r')
+
+        self.cache_dir = cache_dir
+
+        # Get model time of each snapshot
+        step_times = read_statistics_times(directory)
+
+        if step_times is None:
+            self.times = None
+        else:
+            self.times = np.array([step_times.get(step,np.nan)
+                                   for step in self.steps])
+
+    def load(self):
+        """
+        Parse every topography file, and save the result if cache_dir is
+        set.
+        """
+        if self.points is not None:
+            return(self)
+
+        snapshots = [read_topography_file(path) for path in 
+                     tqdm(self.files.values(),disable=self.disable_tqdm)]
+
+        self.offsets = np.concatenate([[0],np.cumsum([len(snapshot) for 
+                                                      snapshot in snapshots])])
+        self.points = np.concatenate(snapshots)
+
+        if self.cache_dir is not None:
+            os.makedirs(self.cache_dir,exist_ok=True)
+
+            # Write to temporary files first, in case of parallel workers
+            suffix = '_'+str(os.getpid())
+            points_temp = self.points_path[:-4]+suffix+'.npy'
+            index_temp = self.index_path[:-4]+suffix+'.npz'
+            np.save(points_temp,self.points)
+            np.savez(index_temp,key=self.key,offsets=self.offsets)
+            os.replace(points_temp,self.points_path)
+            os.replace(index_temp,self.index_path)
+
+        return(self)
+
+    def __len__(self):
+        return(len(self.steps))
+
+    def snapshot(self,k):
+        """
+        Get topography for the kth snapshot.
+        """
+        if self.points is None:
+            return(read_topography_file(list(self.files.values())[k]))
+
+        k = range(len(self.steps))[k]
+
+        return(np.array(self.points[self.offsets[k]:self.offsets[k+1]]))
+
+    def at_step(self,step):
+        """
+        Get topography for a time step number.
+
+        Returns
+        -------
+        topo: NumPy array of surface X and Y positions (columns), which can
+            be passed to vtk_plot.get_surface_particles.
+        """
+        k = np.searchsorted(self.steps,step)
+
+        if k==len(self.steps) or self.steps[k]!=step:
+            raise Exception('No topography for time step '+str(step))
+
+        return(self.snapshot(k))
+
+    def at_time(self,time):
+        """
+        Get topography for the snapshot closest to a model time (years).
+
+        Returns
+        -------
+        topo: NumPy array of surface X and Y positions (columns).
+        """
+        if self.times is None:
+            raise Exception('No statistics file for model times')
+
+        k = np.nanargmin(np.abs(self.times-time))
+
+        return(self.snapshot(k))
+
+    def last(self):
+        """
+        Get topography for the last time step.
+        """
+        return(self.snapshot(-1))
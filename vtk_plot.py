@@ -3,29 +3,160 @@ Functions for plotting data from VTU/PVTU files.
 """
 import os
 import gc
+import json
 import shutil
+import hashlib
+import secrets
+import threading
+from collections import OrderedDict
+from contextlib import closing
+from multiprocessing import shared_memory,resource_tracker,parent_process
 
 import pandas as pd
 import matplotlib.pyplot as plt
 import numpy as np
 import pyvista as pv
 from tqdm import tqdm
-from joblib import Parallel,delayed,dump,load
+from joblib import Parallel,delayed,dump,load,effective_n_jobs
 from scipy.spatial import KDTree
 from matplotlib import cm,colors
+from matplotlib.backends.backend_agg import FigureCanvasAgg
+from vtkmodules.vtkCommonDataModel import vtkStaticCellLocator,vtkGenericCell
 
 from tchron import tchron as tc
+import topography as tp
+
+try:
+    import cv2
+except ImportError:
+    cv2 = None
+
+try:
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+except ImportError:
+    pa = None
+
+# Memory (bytes) allowed for loaded and clipped meshes kept by read_mesh
+MESH_CACHE_BYTES = 2*1024**3
+
+_mesh_cache = OrderedDict()
+_mesh_cache_lock = threading.Lock()
+
+# Directory for sampling plans saved by get_sampling_plan, if asked to
+PLAN_CACHE_DIR = os.path.expanduser('~/.cache/riftinversion/sampling_plans')
+
+# Disk space (bytes) allowed for saved sampling plans
+PLAN_CACHE_BYTES = 512*1024**2
+
+# Number of sampling plans kept in memory
+PLAN_CACHE_SIZE = 8
+
+_plan_cache = OrderedDict()
+
+# Number of parsed topography files kept in memory
+TOPOGRAPHY_CACHE_SIZE = 256
+
+_topography_cache = OrderedDict()
+
+def read_mesh(file,bounds=None,cache=True):
+    """
+    Read and optionally clip a VTU/PVTU file, reusing recently loaded meshes.
+    
+    Meshes are kept in a least-recently-used cache keyed by (path, 
+    modification time, bounds), so a file that changes on disk is read 
+    again. The oldest meshes are evicted once the cache holds more than 
+    MESH_CACHE_BYTES (0 turns the cache off). A shallow copy is returned, 
+    so fields added to it (e.g. comp_field) do not change the cached mesh.
+    
+    Parameters
+    ----------
+    file: Path to VTU or PVTU file, or a Pyvista mesh (clipped if bounds 
+        are given, but not cached).
+    bounds: List of bounds (km) by which to clip the mesh. The default is 
+        None (no clipping).
+    cache: Whether to use the cache. The default is True.
+    
+    Returns
+    -------
+    mesh: Pyvista mesh
+    """
+    if isinstance(file,pv.DataSet):
+        return(clip_mesh(file,bounds))
+    
+    if (cache==False) | (MESH_CACHE_BYTES <= 0):
+        return(clip_mesh(pv.read(file),bounds))
+    
+    path = os.path.abspath(file)
+    if bounds is not None:
+        bounds = tuple(bounds)
+    key = (path,os.path.getmtime(path),bounds)
+    
+    with _mesh_cache_lock:
+        if key in _mesh_cache:
+            _mesh_cache.move_to_end(key)
+            return(_mesh_cache[key][0].copy(deep=False))
+        
+        # Clip from the unclipped mesh if already loaded
+        full_key = (path,key[1],None)
+        full_mesh = _mesh_cache.get(full_key,(None,))[0]
+    
+    if full_mesh is None:
+        mesh = clip_mesh(pv.read(path),bounds)
+    else:
+        mesh = clip_mesh(full_mesh,bounds)
+    
+    # Memory size reported in KiB
+    nbytes = mesh.actual_memory_size*1024
+    
+    with _mesh_cache_lock:
+        # Drop meshes read before the file last changed
+        for old_key in [k for k in _mesh_cache if (k[0]==path)&(k[1]!=key[1])]:
+            del _mesh_cache[old_key]
+        
+        _mesh_cache[key] = (mesh,nbytes)
+        
+        # Evict least recently used meshes, keeping the newest
+        total = sum(entry[1] for entry in _mesh_cache.values())
+        while (total > MESH_CACHE_BYTES) & (len(_mesh_cache) > 1):
+            old_key,(old_mesh,old_nbytes) = _mesh_cache.popitem(last=False)
+            total -= old_nbytes
+    
+    return(mesh.copy(deep=False))
+
+def clip_mesh(mesh,bounds):
+    """
+    Clip a mesh to bounds given in km. 2D bounds are extended with z=0.
+    """
+    if bounds is None:
+        return(mesh)
+    
+    km2m = 1000
+    bounds_m = [bound*km2m for bound in bounds] # Convert bounds to m
+    if len(bounds_m)==4:
+        bounds_m = bounds_m + [0,0]
+    mesh = mesh.clip_box(bounds=bounds_m,invert=False)
+    
+    return(mesh)
+
+def clear_mesh_cache():
+    """
+    Empty the cache of meshes used by read_mesh.
+    """
+    with _mesh_cache_lock:
+        _mesh_cache.clear()
 
 def plot2D(file,field,bounds,ax=None,contours=False,colorbar=False,
          cfields=['crust_upper','crust_lower','mantle_lithosphere'],
          null_field='asthenosphere',contour_color='black',
-         contours_only=False,**kwargs):
+         contours_only=False,session=None,renderer='vtk',**kwargs):
     """
     Plot 2D ASPECT results using Pyvista.
 
     Parameters
     ----------
-    file : VTU or PVTU file to plot
+    file : VTU or PVTU file to plot, or a Pyvista mesh. Files are read 
+        through read_mesh, so repeated plots of a file reuse the mesh.
     field : Field to use for color.
     bounds : List of bounds (km) by which to clip the plot.
     contours : Boolean for whether to add temperature contours. 
@@ -34,82 +165,732 @@ def plot2D(file,field,bounds,ax=None,contours=False,colorbar=False,
         The default is ['crust_upper','crust_lower','mantle_lithosphere'].
     null_field : Null field if field is 'comp_field.'
         The default is 'asthenosphere'.
+    session : RenderSession to render with. Reusing one session across 
+        calls avoids creating a render window for every panel. The default
+        is None (create and close a session for this call only).
+    renderer : 'vtk' to render with Pyvista, or 'raster' to resample the 
+        mesh onto a pixel grid and draw it with matplotlib (see 
+        plot2D_multi). The default is 'vtk'.
 
     Returns
     -------
 
     """
     
-    mesh = pv.read(file)
+    panel = dict(contours=contours,colorbar=colorbar,
+                 contours_only=contours_only,**kwargs)
     
-    km2m = 1000
-    bounds_m = [bound*km2m for bound in bounds] # Convert bounds to m
-    bounds_3D = bounds_m + [0,0]
-    mesh = mesh.clip_box(bounds=bounds_3D,invert=False)
+    axs = plot2D_multi(file,[(field,panel)],bounds,ax,cfields=cfields,
+                       null_field=null_field,contour_color=contour_color,
+                       session=session,renderer=renderer)
+    
+    return(axs[0])
+
+def plot2D_multi(file,panels,bounds,axs=None,
+                 cfields=['crust_upper','crust_lower','mantle_lithosphere'],
+                 null_field='asthenosphere',contour_color='black',
+                 session=None,renderer='vtk',width=1024):
+    """
+    Plot several fields of one 2D ASPECT result, reading and clipping the 
+    file once.
+    
+    The compositional field and temperature contours are also calculated 
+    only once, however many panels use them.
+
+    Parameters
+    ----------
+    file : VTU or PVTU file to plot, or a Pyvista mesh.
+    panels : List of (field, kwargs) tuples, one per panel. kwargs may 
+        include the plot2D options contours, colorbar, and contours_only, 
+        and otherwise are passed to Plotter.add_mesh.
+    bounds : List of bounds (km) by which to clip the plot.
+    axs : List of axes, one per panel. If a single axes is given, every 
+        panel is overlain on it in order (e.g. comp_field with strain on 
+        top). The default is None (overlay on the current axes).
+    cfields : Names of compositional fields to use if a field is 
+        'comp_field.' The default is 
+        ['crust_upper','crust_lower','mantle_lithosphere'].
+    null_field : Null field if a field is 'comp_field.'
+        The default is 'asthenosphere'.
+    session : RenderSession to render with. The default is None (create 
+        and close a session for this call only).
+    renderer : 'vtk' to render each panel with Pyvista and show the 
+        screenshot, or 'raster' to resample the mesh onto a pixel grid with 
+        rasterize and draw it directly with imshow and contour. The raster 
+        renderer needs no OpenGL or display. It accepts the panel kwargs 
+        cmap, clim, log_scale, and opacity (a single value), and passes any 
+        others to imshow. The default is 'vtk'.
+    width : Width of the image (pixels); the height follows from the 
+        bounds. The default is 1024.
+
+    Returns
+    -------
+    axs : List of axes used for each panel.
+
+    """
+    if axs is None:
+        axs = plt.gca()
+    
+    # Single axes overlays all panels
+    if isinstance(axs,plt.Axes):
+        axs = [axs]*len(panels)
+    else:
+        axs = list(np.ravel(axs))
+    
+    if len(axs) != len(panels):
+        raise Exception('Number of axes does not match number of panels')
     
-    if field=='comp_field':
+    mesh = read_mesh(file,bounds)
+    
+    fields = [field for field,panel in panels]
+    
+    if 'comp_field' in fields:
         mesh = comp_field_vtk(mesh,fields=cfields,null_field=null_field)
     
-    if contours==True:
-        cntrs = add_contours(mesh)
+    any_contours = any(panel.get('contours',False) for field,panel in panels)
     
-    pv.set_plot_theme("document")
-    plotter = pv.Plotter(off_screen=True)
-    sargs = dict(width=0.6,fmt='%.1e',height=0.2,label_font_size=32,
-                 position_x=0.1)
+    if renderer=='raster':
+        # Sample every field needed onto the pixel grid at once
+        raster_fields = [field for field,panel in panels 
+                         if panel.get('contours_only',False)==False]
+        if any_contours:
+            raster_fields.append('T')
+        
+        rasters = rasterize(mesh,list(set(raster_fields)),bounds,width)
+        
+        for ax,(field,panel) in zip(axs,panels):
+            raster_panel(ax,rasters,field,bounds,contour_color=contour_color,
+                         **panel)
+        
+        return(axs)
     
+    elif renderer!='vtk':
+        raise Exception('Renderer Not Found')
     
-    if contours_only==False:
-        plotter.add_mesh(mesh,scalars=field,scalar_bar_args=sargs,**kwargs)
+    if any_contours:
+        cntrs = add_contours(mesh)
     
-    if contours ==True:
-        plotter.add_mesh(cntrs,color=contour_color,line_width=5)
+    if session is None:
+        render_session = RenderSession(window_size=width)
+    else:
+        render_session = session
     
-    plotter.view_xy()
+    for ax,(field,panel) in zip(axs,panels):
+        panel = dict(panel)
+        contours = panel.pop('contours',False)
+        
+        if contours==True:
+            panel['cntrs'] = cntrs
+        
+        img = render_session.render(mesh,field,bounds,
+                                    contour_color=contour_color,**panel)
+        
+        # Plot using imshow
+        ax.imshow(img,aspect='equal',extent=bounds)
     
-    if (colorbar==False)&(contours_only==False):
-        plotter.remove_scalar_bar()
+    if session is None:
+        render_session.close()
     
-    plotter.enable_depth_peeling(10)
+    return(axs)
 
+class RenderSession:
+    """
+    Persistent off-screen Pyvista renderer for plot2D.
+    
+    Keeps one render window alive and swaps the mesh actors, scalars, and 
+    camera between calls, rather than creating and closing a window for 
+    every panel. Use as a context manager, or call close() when finished.
+    
+    Parameters
+    ----------
+    window_size: Width of the rendered image (pixels). The height follows 
+        from the aspect ratio of the bounds. The default is 1024.
+    bounds: Optional default bounds (km) to use when render is not given 
+        bounds.
+    """
+    
+    def __init__(self,window_size=1024,bounds=None):
+        self.window_size = window_size
+        self.bounds = bounds
+        
+        pv.set_plot_theme("document")
+        self.plotter = pv.Plotter(off_screen=True)
+        self.plotter.enable_depth_peeling(10)
+    
+    def __enter__(self):
+        return(self)
+    
+    def __exit__(self,*args):
+        self.close()
+    
+    def render(self,mesh,field,bounds=None,cntrs=None,colorbar=False,
+               contour_color='black',contours_only=False,**kwargs):
+        """
+        Render a clipped mesh to an image.
+        
+        Parameters
+        ----------
+        mesh: Pyvista mesh, already clipped to bounds.
+        field: Field to use for color.
+        bounds: List of bounds (km) for the camera. The default is None 
+            (use the session bounds).
+        cntrs: Optional Pyvista mesh of contours to overlay.
+        colorbar: Whether to keep the Pyvista scalar bar.
+        kwargs: Passed to Plotter.add_mesh.
+        
+        Returns
+        -------
+        img: NumPy array of the RGBA image.
+        """
+        if bounds is None:
+            bounds = self.bounds
+        
+        plotter = self.plotter
+        
+        # Remove actors and scalar bars from the previous call. Nothing is
+        # rendered until the end, since each render redraws the live window.
+        plotter.clear_actors()
+        plotter.scalar_bars.clear()
+        
+        sargs = dict(width=0.6,fmt='%.1e',height=0.2,label_font_size=32,
+                     position_x=0.1)
+        
+        if contours_only==False:
+            plotter.add_mesh(mesh,scalars=field,scalar_bar_args=sargs,
+                             show_scalar_bar=colorbar,render=False,**kwargs)
+        
+        if cntrs is not None:
+            plotter.add_mesh(cntrs,color=contour_color,line_width=5,
+                             render=False)
+        
+        # Calculate Camera Position from Bounds. The camera is fully set 
+        # here, since view_xy would also rescale a reused camera.
+        km2m = 1000
+        bounds_array = np.array(bounds)*km2m
+        xmag = float(abs(bounds_array[1] - bounds_array[0]))
+        ymag = float(abs(bounds_array[3] - bounds_array[2]))
+        aspect_ratio = ymag/xmag
+      
+        window_size = [self.window_size,int(self.window_size*aspect_ratio)]
+        if list(plotter.window_size) != window_size:
+            plotter.window_size = window_size
+        
+        xmid = xmag/2 + bounds_array[0] # X midpoint
+        ymid = ymag/2 + bounds_array[2] # Y midpoint
+        zoom = xmag*aspect_ratio*1.875 # Zoom level - not sure why 1.875 works
+        
+        position = (xmid,ymid,zoom)
+        focal_point = (xmid,ymid,0)
+        viewup = (0,1,0)
+        
+        camera = [position,focal_point,viewup]
+        
+        plotter.camera_position = camera
+        plotter.camera_set = True
+        
+        # Render changes once, then create image
+        plotter.render()
+        img = plotter.screenshot(transparent_background=True,
+                                 return_img=True)
+        
+        return(img)
+    
+    def close(self):
+        """
+        Close the render window.
+        """
+        self.plotter.close()
 
-    # Calculate Camera Position from Bounds
-    bounds_array = np.array(bounds_m)
+def rasterize(mesh,fields,bounds,width=1024,plan=False,save_plan=False):
+    """
+    Resample fields of a 2D mesh onto a regular grid of pixels.
+    
+    Interpolates point data at the center of each pixel, so the image can 
+    be drawn directly with imshow and an exact extent instead of rendering
+    and screenshotting the mesh. By default, VTK's probe filter samples the
+    mesh directly. Alternatively, a SamplingPlan can be built and reused for
+    every field and timestep with the same mesh topology. Building a plan 
+    is slower than one probe, so this only helps when the mesh is not 
+    refined between timesteps.
+    
+    Parameters
+    ----------
+    mesh: Pyvista mesh (e.g. from read_mesh).
+    fields: Name of a field, or list of field names, to sample.
+    bounds: List of bounds (km) covered by the image.
+    width: Width of the image (pixels). The height follows from the aspect 
+        ratio of the bounds. The default is 1024.
+    plan: Whether to use a cached SamplingPlan (see get_sampling_plan). 
+        The default is False.
+    save_plan: Whether to also save the plan to disk (see 
+        get_sampling_plan). The default is False.
+    
+    Returns
+    -------
+    raster: NumPy array of shape (height, width) with the first row at the
+        bottom (use origin='lower'), and np.nan outside the mesh. A 
+        dictionary of arrays by field if fields is a list.
+    """
+    if plan==True:
+        sampling_plan = get_sampling_plan(mesh,bounds,width,save=save_plan)
+        
+        rasters = {}
+        for field in np.atleast_1d(fields):
+            rasters[field] = sampling_plan.sample(mesh,field)
+        
+        if isinstance(fields,str):
+            return(rasters[fields])
+        
+        return(rasters)
+    
+    km2m = 1000
+    bounds_array = np.array(bounds[:4],dtype=float)*km2m
     xmag = float(abs(bounds_array[1] - bounds_array[0]))
     ymag = float(abs(bounds_array[3] - bounds_array[2]))
-    aspect_ratio = ymag/xmag
-  
-    plotter.window_size = (1024,int(1024*aspect_ratio))
+    height = int(width*ymag/xmag)
+    
+    dx = xmag/width
+    dy = ymag/height
+    
+    # Grid of pixel centers
+    grid = pv.ImageData(dimensions=(width,height,1),spacing=(dx,dy,1),
+                        origin=(bounds_array[0]+dx/2,bounds_array[2]+dy/2,0))
+    
+    sampled = grid.sample(mesh)
+    valid = sampled.point_data['vtkValidPointMask'].reshape(height,width)
+    
+    rasters = {}
+    for field in np.atleast_1d(fields):
+        values = sampled.point_data[field].reshape(height,width)
+        rasters[field] = np.where(valid==1,values,np.nan)
+    
+    if isinstance(fields,str):
+        return(rasters[fields])
     
-    xmid = xmag/2 + bounds_array[0] # X midpoint
-    ymid = ymag/2 + bounds_array[2] # Y midpoint
-    zoom = xmag*aspect_ratio*1.875 # Zoom level - not sure why 1.875 works
+    return(rasters)
+
+def topology_hash(mesh):
+    """
+    Hash the points and cells of a mesh, ignoring its data fields.
+    """
+    cells = mesh.GetCells()
     
-    position = (xmid,ymid,zoom)
-    focal_point = (xmid,ymid,0)
-    viewup = (0,1,0)
+    sha = hashlib.sha1()
+    for array in (np.asarray(mesh.points),
+                  pv.convert_array(cells.GetOffsetsArray()),
+                  pv.convert_array(cells.GetConnectivityArray()),
+                  np.asarray(mesh.celltypes)):
+        sha.update(np.ascontiguousarray(array).tobytes())
     
-    camera = [position,focal_point,viewup]
-    # print(camera)
+    return(sha.hexdigest())
+
+class SamplingPlan:
+    """
+    Map from each pixel of a raster to the mesh cell containing it and the 
+    interpolation weights of that cell's points.
     
-    plotter.camera_position = camera
-    plotter.camera_set = True
+    Building the plan locates every pixel center once, one pixel at a time,
+    so it takes longer than one probe filter. Sampling a field is then a 
+    gather and weighted sum, for any field of any mesh with the same
+    topology (e.g. every timestep of a model without mesh refinement).
     
-    # Create image
-    img = plotter.screenshot(transparent_background=True,
-                             return_img=True)
+    Parameters
+    ----------
+    mesh: Pyvista mesh (e.g. from read_mesh).
+    bounds: List of bounds (km) covered by the raster.
+    width: Width of the raster (pixels). The height follows from the 
+        aspect ratio of the bounds. The default is 1024.
+    """
     
-    # Plot using imshow
-    if ax is None:
-        ax = plt.gca()
+    def __init__(self,mesh=None,bounds=None,width=1024):
+        # Empty plan for load
+        if mesh is None:
+            return
+        
+        km2m = 1000
+        bounds_array = np.array(bounds[:4],dtype=float)*km2m
+        xmag = float(abs(bounds_array[1] - bounds_array[0]))
+        ymag = float(abs(bounds_array[3] - bounds_array[2]))
+        height = int(width*ymag/xmag)
+        
+        dx = xmag/width
+        dy = ymag/height
+        
+        # Pixel centers, with the first row at the bottom
+        x = bounds_array[0] + dx*(np.arange(width)+0.5)
+        y = bounds_array[2] + dy*(np.arange(height)+0.5)
+        xx,yy = np.meshgrid(x,y)
+        pixels = np.column_stack([xx.ravel(),yy.ravel(),
+                                  np.zeros(xx.size)])
+        
+        # Locate each pixel and get interpolation weights
+        max_points = mesh.GetMaxCellSize()
+        
+        locator = vtkStaticCellLocator()
+        locator.SetDataSet(mesh)
+        locator.BuildLocator()
+        
+        cell = vtkGenericCell()
+        pcoords = np.zeros(3)
+        cell_weights = np.zeros(max_points)
+        
+        cell_ids = np.empty(len(pixels),dtype=np.int64)
+        weights = np.zeros((len(pixels),max_points))
+        for k,pixel in enumerate(pixels):
+            cell_ids[k] = locator.FindCell(pixel,0.0,cell,pcoords,
+                                           cell_weights)
+            weights[k] = cell_weights
+        
+        valid = cell_ids >= 0
+        weights[~valid] = 0
+        
+        # Get point ids of each pixel's cell
+        cells = mesh.GetCells()
+        offsets = pv.convert_array(cells.GetOffsetsArray())
+        connectivity = pv.convert_array(cells.GetConnectivityArray())
+        
+        start = offsets[np.where(valid,cell_ids,0)]
+        n_points = np.diff(offsets)[np.where(valid,cell_ids,0)]
+        
+        point_ids = np.zeros((len(pixels),max_points),dtype=np.int64)
+        for j in range(max_points):
+            has_point = valid & (j < n_points)
+            point_ids[has_point,j] = connectivity[start[has_point]+j]
+        
+        self.shape = (height,width)
+        self.cell_ids = cell_ids.astype(np.int32)
+        self.point_ids = point_ids.astype(np.int32)
+        self.weights = weights.astype(np.float32)
+        self.valid = valid
+    
+    def sample(self,mesh,field):
+        """
+        Sample a field of a mesh with the same topology as the plan.
+        
+        Returns
+        -------
+        raster: NumPy array of shape (height, width), with the first row at 
+            the bottom and np.nan outside the mesh.
+        """
+        if field in mesh.point_data.keys():
+            values = np.asarray(mesh.point_data[field])
+            raster = (values[self.point_ids]*self.weights).sum(axis=1)
+        else:
+            values = np.asarray(mesh.cell_data[field])
+            raster = values[np.where(self.valid,self.cell_ids,0)]
+        
+        raster = np.where(self.valid,raster,np.nan)
+        
+        return(raster.reshape(self.shape))
+    
+    def save(self,path):
+        """
+        Save the plan to a compressed .npz file.
+        """
+        np.savez_compressed(path,shape=self.shape,cell_ids=self.cell_ids,
+                 point_ids=self.point_ids,weights=self.weights,
+                 valid=self.valid)
+    
+    @classmethod
+    def load(cls,path):
+        """
+        Load a plan saved with save.
+        """
+        plan = cls()
+        with np.load(path) as data:
+            plan.shape = tuple(data['shape'])
+            plan.cell_ids = data['cell_ids']
+            plan.point_ids = data['point_ids']
+            plan.weights = data['weights']
+            plan.valid = data['valid']
+        
+        return(plan)
+
+def get_sampling_plan(mesh,bounds,width=1024,save=False,cache_dir=None):
+    """
+    Get the SamplingPlan for a mesh, bounds, and width, reusing a plan from
+    memory (or disk, if saved) if the mesh topology is unchanged.
+    
+    Plans are keyed by a hash of the mesh points and cells (topology_hash),
+    bounds, and width, so a change to the mesh (e.g. refinement) builds a 
+    new plan. The last PLAN_CACHE_SIZE plans are kept in memory. Saved plans
+    are removed oldest first once they take more than PLAN_CACHE_BYTES, and
+    the directory can be deleted at any time.
+    
+    Parameters
+    ----------
+    mesh: Pyvista mesh (e.g. from read_mesh).
+    bounds: List of bounds (km) covered by the raster.
+    width: Width of the raster (pixels). The default is 1024.
+    save: Whether to also load and save plans on disk. The default is 
+        False.
+    cache_dir: Directory to save plans in. The default (None) uses 
+        PLAN_CACHE_DIR.
     
-    ax.imshow(img,aspect='equal',extent=bounds)
+    Returns
+    -------
+    plan: SamplingPlan
+    """
+    key = topology_hash(mesh)+'_'+'_'.join(str(float(bound)) 
+                                           for bound in bounds[:4])
+    key = key+'_'+str(width)
+    
+    if key in _plan_cache:
+        _plan_cache.move_to_end(key)
+        return(_plan_cache[key])
+    
+    if save:
+        if cache_dir is None:
+            cache_dir = PLAN_CACHE_DIR
+        path = os.path.join(cache_dir,
+                            hashlib.sha1(key.encode()).hexdigest()+'.npz')
+    
+    if save and os.path.exists(path):
+        plan = SamplingPlan.load(path)
+        os.utime(path)
+    else:
+        plan = SamplingPlan(mesh,bounds,width)
+        
+        if save:
+            os.makedirs(cache_dir,exist_ok=True)
+            
+            # Write to a temporary file first, in case of parallel workers
+            temp_path = path[:-4]+'_'+str(os.getpid())+'.npz'
+            plan.save(temp_path)
+            os.replace(temp_path,path)
+            
+            trim_plan_cache(cache_dir)
     
-    plotter.clear()
-    pv.close_all()
+    _plan_cache[key] = plan
+    while len(_plan_cache) > PLAN_CACHE_SIZE:
+        _plan_cache.popitem(last=False)
+    
+    return(plan)
+
+def trim_plan_cache(cache_dir=None,max_bytes=None):
+    """
+    Delete the least recently used saved sampling plans until the directory
+    takes at most max_bytes (default PLAN_CACHE_BYTES).
+    """
+    if cache_dir is None:
+        cache_dir = PLAN_CACHE_DIR
+    if max_bytes is None:
+        max_bytes = PLAN_CACHE_BYTES
+    
+    entries = []
+    with os.scandir(cache_dir) as scan:
+        for entry in scan:
+            if entry.name.endswith('.npz') and entry.is_file():
+                stat = entry.stat()
+                entries.append((stat.st_mtime,stat.st_size,entry.path))
+    
+    total = sum(entry[1] for entry in entries)
+    for mtime,size,path in sorted(entries):
+        if total <= max_bytes:
+            break
+        try:
+            os.remove(path)
+        except FileNotFoundError:
+            pass
+        total -= size
+
+def raster_panel(ax,rasters,field,bounds,contours=False,colorbar=False,
+                 contours_only=False,contour_color='black',cmap=None,
+                 clim=None,log_scale=False,opacity=None,
+                 contour_values=np.arange(500,1700,200),**kwargs):
+    """
+    Draw one panel of plot2D_multi from rasters made by rasterize.
+    
+    Parameters
+    ----------
+    ax: Matplotlib axes.
+    rasters: Dictionary of rasters by field, including 'T' for contours.
+    field: Field to use for color.
+    bounds: List of bounds (km) covered by the rasters.
+    contour_values: Temperatures (K) to contour, as in add_contours.
+    kwargs: Passed to imshow.
+    
+    Returns
+    -------
+    ax: Matplotlib axes.
+    """
+    extent = bounds[:4]
+    
+    if contours_only==False:
+        if clim is None:
+            clim = [None,None]
+        
+        if log_scale==True:
+            norm = colors.LogNorm(vmin=clim[0],vmax=clim[1])
+        else:
+            norm = colors.Normalize(vmin=clim[0],vmax=clim[1])
+        
+        image = ax.imshow(rasters[field],origin='lower',extent=extent,
+                          aspect='equal',cmap=cmap,norm=norm,alpha=opacity,
+                          **kwargs)
+        
+        if colorbar==True:
+            plt.colorbar(image,ax=ax)
+    
+    if contours==True:
+        temps = rasters['T']
+        height,width = temps.shape
+        
+        # Pixel centers (km)
+        x = np.linspace(extent[0],extent[1],width,endpoint=False)
+        x = x + (extent[1]-extent[0])/width/2
+        y = np.linspace(extent[2],extent[3],height,endpoint=False)
+        y = y + (extent[3]-extent[2])/height/2
+        
+        ax.contour(x,y,temps,levels=contour_values,colors=contour_color,
+                   linewidths=1)
     
     return(ax)
 
+# Render session held by each video worker process
+_worker_session = None
+
+def worker_session():
+    """
+    Get the RenderSession of the current process, creating it on first use.
+    """
+    global _worker_session
+    
+    if _worker_session is None:
+        # Frames are drawn to arrays, so workers need no display. Leave the
+        # backend of the main process (e.g. with processes=1) alone.
+        if parent_process() is not None:
+            plt.switch_backend('agg')
+        _worker_session = RenderSession()
+    
+    return(_worker_session)
+
+def close_worker_session():
+    """
+    Close the RenderSession of the current process, if any.
+    """
+    global _worker_session
+    
+    if _worker_session is not None:
+        _worker_session.close()
+        _worker_session = None
+
+def figure_to_array(fig):
+    """
+    Draw a matplotlib figure and return it as a BGR image for OpenCV.
+    
+    The figure is drawn with an Agg canvas, whatever the current backend.
+    """
+    canvas = FigureCanvasAgg(fig)
+    canvas.draw()
+    rgba = np.asarray(canvas.buffer_rgba())
+    
+    # Reorder RGB to BGR and drop alpha
+    img = np.ascontiguousarray(rgba[...,2::-1])
+    
+    return(img)
+
+def render_frame(frame_function,frame,mesh_cache_bytes=0):
+    """
+    Render one video frame in a worker, using the worker's RenderSession.
+    
+    Parameters
+    ----------
+    frame_function: Function taking (frame, session) and returning a 
+        matplotlib figure.
+    frame: Argument describing the frame (e.g. timestep and file).
+    mesh_cache_bytes: Memory (bytes) allowed for the read_mesh cache while
+        drawing the frame. The default is 0 (no cache).
+    
+    Returns
+    -------
+    img: NumPy array of the BGR frame.
+    """
+    global MESH_CACHE_BYTES
+    
+    session = worker_session()
+    
+    # Each frame usually reads a different file, so limit the cache
+    previous_bytes = MESH_CACHE_BYTES
+    MESH_CACHE_BYTES = mesh_cache_bytes
+    try:
+        fig = frame_function(frame,session)
+    finally:
+        MESH_CACHE_BYTES = previous_bytes
+    
+    img = figure_to_array(fig)
+    plt.close(fig)
+    
+    return(img)
+
+def make_video(frame_function,frames,filename,frame_rate,
+               processes=os.cpu_count()-2,fourcc='mp4v',mesh_cache_bytes=0):
+    """
+    Render video frames in parallel and write them to a video with OpenCV.
+    
+    Each worker process keeps its own off-screen RenderSession for all of 
+    its frames. Frames are returned as arrays in order and written straight
+    to the cv2.VideoWriter, without saving images to disk.
+    
+    Parameters
+    ----------
+    frame_function: Function taking (frame, session) and returning a 
+        matplotlib figure. Pass session to plot2D or plot2D_multi. Every 
+        frame must have the same figure size and dpi.
+    frames: List of arguments describing each frame (e.g. tuples of 
+        timestep and file), in video order.
+    filename: Path of the output video.
+    frame_rate: Frames per second.
+    processes: Number of worker processes. The default is 
+        os.cpu_count()-2.
+    fourcc: OpenCV codec code. The default is 'mp4v'.
+    mesh_cache_bytes: Memory (bytes) each worker may use to cache meshes 
+        with read_mesh. Frames usually read different files, so the default
+        is 0 (no cache).
+    
+    Returns
+    -------
+    
+    """
+    if cv2 is None:
+        raise Exception('OpenCV (cv2) is required to write videos')
+    
+    print('Rendering Frames...')
+    print('Processes: ',processes)
+    
+    video = None
+    
+    try:
+        with Parallel(n_jobs=processes,return_as='generator') as parallel:
+            output = parallel(delayed(render_frame)(frame_function,frame,
+                                                    mesh_cache_bytes)
+                              for frame in frames)
+            
+            for img in tqdm(output,total=len(frames)):
+                height,width,layers = img.shape
+                
+                # Open video with size of first frame
+                if video is None:
+                    size = (width,height)
+                    video = cv2.VideoWriter(filename,
+                                            cv2.VideoWriter_fourcc(*fourcc),
+                                            frame_rate,size)
+                
+                if (width,height) != size:
+                    raise Exception('Frame size changed from '+str(size)+
+                                    ' to '+str((width,height)))
+                
+                video.write(img)
+    
+    finally:
+        # Close session if frames were rendered in this process
+        close_worker_session()
+        
+        if video is not None:
+            video.release()
+    
+    return
+
 def add_colorbar(fig,vmin=None,vmax=None,cmap='viridis',location=[0.1,0.08,0.8,0.02],
                  orientation='horizontal',log=False,**kwargs):
     cax = fig.add_axes(location)
@@ -127,6 +908,9 @@ def add_colorbar(fig,vmin=None,vmax=None,cmap='viridis',location=[0.1,0.08,0.8,0
 def add_contours(mesh,field='T',values=np.arange(500,1700,200)):
     """
     Add contours to mesh in Pyvista.
+    
+    Contours are calculated directly from the mesh, which is not modified,
+    so no copy of the mesh is made.
 
     Parameters
     ----------
@@ -140,18 +924,18 @@ def add_contours(mesh,field='T',values=np.arange(500,1700,200)):
     cntrs: Pyvista mesh containing the contours.
 
     """
-    contour_mesh = mesh.copy()
-    cntrs = contour_mesh.contour(isosurfaces=values,scalars=field)
+    cntrs = mesh.contour(isosurfaces=values,scalars=field)
     return(cntrs)
     
 
 def comp_field_vtk(mesh,fields=['crust_upper','crust_lower','mantle_lithosphere'],
-               null_field='asthenosphere'):
+               null_field='asthenosphere',threshold=0.5,data='point'):
     """
     Calculate compositional field from Pyvista VTK mesh.
     
-    Uses input fields to assign value based on when fields are >0.9. Any point
-    lacking a field >0.9 is assigned to the null field.
+    Uses input fields to assign value based on when fields are >0.5. Any point
+    lacking a field >0.5 is assigned to the null field (0). Where several 
+    fields are >0.5, the last field in the list is used.
 
     Parameters
     ----------
@@ -160,38 +944,166 @@ def comp_field_vtk(mesh,fields=['crust_upper','crust_lower','mantle_lithosphere'
         The default is ['crust_upper','crust_lower','mantle_lithosphere'].
     null_field : Name of field for points not included in compositional fields.
         The default is 'asthenosphere'.
+    threshold : Value a field must exceed to be assigned. The default is 0.5.
+    data : 'point' to classify point data, or 'cell' to classify cell data
+        (averaging point data over each cell if the fields are not cell 
+        data). The default is 'point'.
 
     Returns
     -------
     mesh: Pyvista mesh with 'comp_field' added as a scalar.
     
     """
-
-    # Create empty np array
-    output = np.zeros(shape=mesh.point_data[fields[0]].shape)
-    for x in range(len(fields)):
-        array = mesh.point_data[fields[x]]
-        output = np.where(array>0.5,x+1,output)
+    if data=='point':
+        arrays = [mesh.point_data[field] for field in fields]
+    elif data=='cell':
+        arrays = [mesh.cell_data[field] if field in mesh.cell_data.keys()
+                  else cell_average(mesh,field) for field in fields]
+    else:
+        raise Exception('Data must be point or cell')
+    
+    output = classify_composition(arrays,threshold)
+    
+    if data=='point':
+        mesh.point_data['comp_field'] = output
+    else:
+        mesh.cell_data['comp_field'] = output
     
-    mesh.point_data['comp_field'] = output
     return(mesh)
 
+def classify_composition(arrays,threshold=0.5):
+    """
+    Classify points by compositional field in one pass over a stack of 
+    fields.
+    
+    Parameters
+    ----------
+    arrays : List of NumPy arrays of compositional fields.
+    threshold : Value a field must exceed to be assigned. The default is 0.5.
+    
+    Returns
+    -------
+    output : NumPy array with the (1-based) index of the last field above 
+        threshold, or 0 where no field is.
+    """
+    # Stack fields as booleans, one column per field
+    above = np.empty((len(arrays[0]),len(arrays)),dtype=bool)
+    for x,array in enumerate(arrays):
+        np.greater(array,threshold,out=above[:,x])
+    
+    # Last field above threshold takes precedence
+    last = above.shape[1] - np.argmax(above[:,::-1],axis=1)
+    output = np.where(above.any(axis=1),last,0).astype(float)
+    
+    return(output)
+
+def cell_average(mesh,field):
+    """
+    Average point data of a mesh over the points of each cell.
+    """
+    cells = mesh.GetCells()
+    offsets = pv.convert_array(cells.GetOffsetsArray())
+    connectivity = pv.convert_array(cells.GetConnectivityArray())
+    
+    values = np.asarray(mesh.point_data[field])[connectivity]
+    sums = np.add.reduceat(values,offsets[:-1],axis=0)
+    
+    average = sums/np.diff(offsets)
+    
+    return(average)
+
+def match_ids(ids,query_ids,sorter=None):
+    """
+    Find the rows of an array of particle ids that match a set of query ids.
+    
+    Uses a sorted index and binary search, so matching all particles between
+    two timesteps is O(N log N) rather than one O(N) scan per particle. If 
+    an id occurs more than once, the first occurrence is used.
+    
+    Parameters
+    ----------
+    ids: NumPy array of particle ids to search (e.g. previous timestep).
+    query_ids: Particle id or NumPy array of particle ids to find.
+    sorter: Optional result of np.argsort(ids,kind='stable'), to reuse
+        the index across calls on the same ids.
+    
+    Returns
+    -------
+    rows: NumPy array of rows of ids for each query id, with -1 where the
+        query id is not present.
+    """
+    ids = np.asarray(ids)
+    query_ids = np.asarray(query_ids)
+    
+    if ids.size == 0:
+        return(np.full(query_ids.shape,-1,dtype=np.int64))
+    
+    if sorter is None:
+        sorter = np.argsort(ids,kind='stable')
+    
+    # Binary search for each query id in the sorted ids
+    positions = np.searchsorted(ids,query_ids,sorter=sorter)
+    positions = np.clip(positions,0,ids.size-1)
+    rows = sorter[positions]
+    
+    rows = np.where(ids[rows]==query_ids,rows,-1)
+    
+    return(rows)
+
 def He_age_vtk_parallel(files,system,time_interval,file_prefix='meshes_He',
                path='./',temp='~/dump',
                U=100,Th=100,radius=50,batch_size=100,processes=os.cpu_count()-2,
-               He_profile_nodes=513,interpolate_profile=True,all_timesteps=True):
+               He_profile_nodes=513,interpolate_profile=True,all_timesteps=True,
+               chunked=True,chunk_size=10000,temp_resolution=None,K=None,
+               keep_profiles=False):
     """
     Function to do parallel He forward modeling of ASPECT VTK data.
+    
+    system may be a single system (e.g. 'AHe') or a list of systems (e.g.
+    ['AHe','ZHe','BtAr']). With several systems, each timestep is read 
+    once, profiles for every system are advanced in the same pass, and the
+    output mesh has one age field per system. Ar systems require K (wt%).
+    
+    By default (chunked=True), each worker receives a contiguous slice of 
+    particles and advances their profiles together with 
+    tchron.forward_model_batch, in sub-batches of at most chunk_size 
+    particles to bound memory. Setting chunked=False dispatches one task per
+    particle with particle_He_profile.
+    
+    He_profile_nodes sets the number of nodes in each stored profile; 
+    fewer nodes reduce memory and runtime roughly in proportion (see 
+    tchron/tests/Ketcham05_nodes.py for accuracy).
+    
+    If temp_resolution (K) is given, temperatures are rounded to it so that
+    particles at the same temperature share cached diffusion operators 
+    (see tchron.factorize_diffusion_step).
+    
+    Profiles are kept on disk in one ProfileStore per system under the 
+    output directory rather than in memory. If a run is interrupted, 
+    calling the function again resumes after the last completed timestep.
+    Once all files are done the stored profiles are deleted, unless 
+    keep_profiles is True, in which case a later call with more files 
+    continues from the last timestep.
     """
     dtype=np.float32
     
+    if isinstance(system,str):
+        systems = [system]
+    else:
+        systems = list(system)
+    
     print('Calculating He Ages...')
-    if batch_size == 'auto':
-        pre_dispatch = 2*processes
+    if chunked == True:
+        # One task per slice of particles, so no batching needed
+        batch_size = 1
+        pre_dispatch = 'all'
+    elif batch_size == 'auto':
+        pre_dispatch = 2*effective_n_jobs(processes)
     else:
         pre_dispatch = 2*batch_size
     
     print('Processes: ',processes)
+    print('Chunked: ',chunked)
     print('Batch Size: ',batch_size)
     print('Pre-Dispatch: ',pre_dispatch)
     
@@ -208,13 +1120,30 @@ def He_age_vtk_parallel(files,system,time_interval,file_prefix='meshes_He',
     new_dir = os.path.join(path,file_prefix)
     os.makedirs(new_dir,exist_ok=True)
     
-    # Path for dump of cached profile
-    cache_path = os.path.join(new_dir,'cache_profile.npy')
+    # On-disk store of profiles from the last completed timestep
+    stores = {}
+    for name in systems:
+        stores[name] = ProfileStore(os.path.join(new_dir,'profile_store_'+name),
+                                   He_profile_nodes,dtype=dtype)
+    
+    # All systems are advanced together, so must resume from the same step
+    last_step = stores[systems[0]].step
+    if any(store.step != last_step for store in stores.values()):
+        raise Exception('Profile stores are at different timesteps; '
+                        'use a new file_prefix to add systems')
+    
+    # Profiles of a finished run are deleted, so it cannot be extended
+    if stores[systems[0]].complete and (len(files) > last_step+1):
+        raise Exception('Run in '+new_dir+' already finished at timestep '
+                        +str(last_step)+' and its profiles were deleted, so '
+                        'it cannot continue to '+str(len(files))+' files; '
+                        'use a new file_prefix or keep_profiles=True')
     
     with Parallel(n_jobs=processes,
                   batch_size=batch_size,
                   pre_dispatch=pre_dispatch,
-                  temp_folder=temp) as parallel:
+                  temp_folder=temp,
+                  return_as='generator') as parallel:
     
         # Loop through timesteps
         for k,file in enumerate(files):  
@@ -222,36 +1151,31 @@ def He_age_vtk_parallel(files,system,time_interval,file_prefix='meshes_He',
             filename = file_prefix+'_'+str(k)+'.vtu'
             filepath = os.path.join(new_dir,filename)
             
-            # Check if timestep already exists
-            if os.path.exists(filepath):
+            # Check if timestep already completed
+            if k <= last_step:
                 print('Timestep ' + str(k) + ' Previously Run')
-                
-                next_filename = file_prefix+'_'+str(k+1)+'.vtu'
-                next_filepath = os.path.join(new_dir,next_filename)
-                
-                # Check if this is the last file to exist
-                if ~os.path.exists(next_filepath):
-                    old_mesh = pv.read(filepath)
-                    ids = old_mesh['id']
-                    positions = old_mesh.points
-                    new_profiles = np.load(cache_path)
                 continue
                    
             mesh = pv.read(file)
             
             temps = mesh['T']
             
+            old_profiles = {}
             if k==0:
-                # Set up empty arrays for first timestep
-                prof_shape = (len(temps),He_profile_nodes)
-                old_profiles = np.empty(prof_shape,dtype=dtype)
-                old_profiles.fill(np.nan)
-                old_ids = np.ones(len(temps),dtype=dtype)*np.nan
-                old_positions = np.ones(len(temps),dtype=dtype)*np.nan
-            elif k>0:  
-                old_profiles=new_profiles
-                old_ids = ids # Get ids for previous profiles
-                old_positions = positions
+                # No previous profiles for first timestep
+                for name in systems:
+                    old_profiles[name] = np.empty((0,He_profile_nodes),
+                                                 dtype=dtype)
+                old_ids = np.empty(0,dtype=dtype)
+                old_positions = np.empty((0,3),dtype=dtype)
+                hasprofile = np.empty(0,dtype=bool)
+            elif k>0:
+                # Get ids, positions, and profiles of previous timestep.
+                # All systems are calculated for the same particles, so ids,
+                # positions, and rows with profiles are shared.
+                for name in systems:
+                    (old_ids,old_positions,
+                     old_profiles[name],hasprofile) = stores[name].load()
             
             gc.collect()
             if k in np.arange(5,len(files),5):
@@ -261,26 +1185,31 @@ def He_age_vtk_parallel(files,system,time_interval,file_prefix='meshes_He',
             ids = mesh['id']
             positions = mesh.points
         
-            # Set up KDTree for timestep if doing interpolation
+            # Get rows of previous profiles for current particles
+            old_rows = match_ids(old_ids,ids)
+            
+            # Particles without a previous profile get the profile of the
+            # nearest particle in the previous timestep, found all at once
             if (k>0)&(interpolate_profile==True):
                 
-                # Get particle ids of particles with profiles
-                hasprofile = ~np.isnan(old_profiles).all(axis=1)
-                other_particles = old_ids[hasprofile]
-                
-                # Get positions of other particles
-                other_positions = old_positions[hasprofile]
+                # Get rows of particles with profiles
+                other_rows = np.flatnonzero(hasprofile)
                 
-                # Set up KDTree to find closest particle
-                tree = KDTree(other_positions)
+                # No stored rows if the previous timestep had no particles
+                if hasprofile.size == 0:
+                    noprofile = np.ones(len(old_rows),dtype=bool)
+                else:
+                    noprofile = ((old_rows<0) | 
+                                 ~hasprofile[np.where(old_rows>=0,old_rows,0)])
                 
-            else:
-                tree=None
-                other_particles=None
-                
-            inputs = (k,positions,tree,ids,old_ids,temps,old_profiles,
-                      U,Th,radius,time_interval,other_particles,
-                      system,He_profile_nodes)
+                if noprofile.any() & (other_rows.size>0):
+                    
+                    # Set up KDTree of other particles to find closest
+                    tree = KDTree(old_positions[other_rows])
+                    distance,index = tree.query(positions[noprofile],
+                                                workers=-1)
+                    
+                    old_rows[noprofile] = other_rows[index]
                 
             # Calculate ages on last timestep only if indicated
             if all_timesteps==True:
@@ -290,27 +1219,79 @@ def He_age_vtk_parallel(files,system,time_interval,file_prefix='meshes_He',
             else:
                 calc_age=False
             
-            print('Caluclating Profiles for Timestep ',k,'...')
+            # Particles start from zero He on the first timestep, or if the
+            # previous timestep had no particles to continue from
+            if len(old_ids) == 0:
+                k_start = 0
+            else:
+                k_start = k
             
-    
-            output = parallel(
-                (delayed(particle_He_profile)
-                 (particle,inputs,calc_age,interpolate_profile) 
-                 for particle in tqdm(ids,position=0))
-                )
+            new_profiles = {}
+            for name in systems:
+                
+                inputs = (k_start,old_rows,temps,old_profiles[name],
+                          U,Th,radius,time_interval,
+                          name,He_profile_nodes,temp_resolution,K)
+                
+                print('Caluclating',name,'Profiles for Timestep ',k,'...')
+                
+                # Write new profiles straight to disk as they are returned
+                new_profiles[name] = stores[name].new_profiles(len(ids))
+                ages = np.empty(len(ids),dtype=dtype)
+                
+                # Number of particles given ages and profiles
+                covered = 0
+                
+                if chunked==True:
+                    # Split particles into one contiguous slice per process
+                    # (processes may be negative, as for joblib)
+                    n_chunks = min(max(effective_n_jobs(processes),1),
+                                   max(len(ids),1))
+                    edges = np.linspace(0,len(ids),n_chunks+1).astype(int)
+                    chunks = [slice(start,stop) for start,stop in 
+                              zip(edges[:-1],edges[1:]) if stop>start]
+                    
+                    output = parallel(
+                        (delayed(chunk_He_profiles)
+                         (chunk,inputs,calc_age,chunk_size)
+                         for chunk in tqdm(chunks,position=0))
+                        )
+                    
+                    # Consume output fully so the generator finishes
+                    for n,(chunk_ages,chunk_profiles) in enumerate(output):
+                        chunk = chunks[n]
+                        ages[chunk] = chunk_ages
+                        new_profiles[name][chunk] = chunk_profiles
+                        covered += chunk.stop-chunk.start
+                
+                else:
+                    output = parallel(
+                        (delayed(particle_He_profile)
+                         (row,inputs,calc_age) 
+                         for row in tqdm(range(len(ids)),position=0))
+                        )
+                    
+                    for row,(age,profile) in enumerate(output):
+                        ages[row] = age
+                        new_profiles[name][row] = profile
+                        covered += 1
+                
+                if covered != len(ids):
+                    raise Exception('Calculated '+str(covered)+' of '
+                                    +str(len(ids))+' particles for timestep '
+                                    +str(k))
             
-            ages,new_profiles = zip(*output)
-        
-            # Convert new_profiles to array and save for reload
-            new_profiles = np.array(new_profiles,dtype=dtype)
-            np.save(cache_path,new_profiles)
-        
-            # Assign ages to mesh
-            mesh.point_data[system] = np.array(ages,dtype=dtype)
+                # Assign ages to mesh
+                mesh.point_data[name] = ages
         
             # Save new mesh
             mesh.save(filepath)
             
+            # Mark timestep as complete only once the mesh is saved
+            for name in systems:
+                stores[name].commit(k,ids,positions,new_profiles[name])
+            del old_profiles,new_profiles
+            
             # Purge the temp folder
             try:
                 shutil.rmtree(temp)
@@ -318,77 +1299,213 @@ def He_age_vtk_parallel(files,system,time_interval,file_prefix='meshes_He',
                 pass
             os.makedirs(temp)
     
-    # Delete cached profile when all finished
-    os.remove(cache_path)
+    # Delete stored profiles when all finished
+    if keep_profiles == False:
+        for store in stores.values():
+            store.finalize()
     
     return
 
-def particle_He_profile(particle,inputs,calc_age,interpolate_profile):
+class ProfileStore:
+    """
+    On-disk store of He profiles for the last completed timestep of 
+    He_age_vtk_parallel, keyed by particle id.
+    
+    Profiles are held in two memory-mapped buffers. Each timestep reads 
+    from the buffer of the last completed step and writes to the other, so
+    an interrupted step never corrupts the profiles needed to resume. The
+    last completed step is recorded in a small JSON marker that is replaced
+    atomically after the step's outputs are written.
     
+    Parameters
+    ----------
+    directory: Directory for the store.
+    nodes: Number of nodes in each profile.
+    dtype: Data type of stored profiles. The default is np.float32.
     """
-    Function to calculate He profile for a particular ASPECT particle.
+    
+    def __init__(self,directory,nodes,dtype=np.float32):
+        self.directory = directory
+        self.nodes = nodes
+        self.dtype = np.dtype(dtype)
+        
+        os.makedirs(directory,exist_ok=True)
+        
+        self.marker_path = os.path.join(directory,'last_step.json')
+        
+        if os.path.exists(self.marker_path):
+            with open(self.marker_path) as f:
+                marker = json.load(f)
+            
+            if marker['nodes'] != nodes:
+                raise Exception('Profile store has '+str(marker['nodes'])
+                                + ' nodes, not '+str(nodes))
+            
+            self.step = marker['step']
+            self.buffer = marker['buffer']
+            self.n_rows = marker['n_rows']
+            self.complete = marker['complete']
+        else:
+            self.step = -1
+            self.buffer = 1
+            self.n_rows = 0
+            self.complete = False
+    
+    def path(self,name,buffer):
+        """
+        Path of a stored array for a buffer.
+        """
+        return(os.path.join(self.directory,name+'_'+str(buffer)))
+    
+    def load(self):
+        """
+        Load the last completed timestep.
+        
+        Returns
+        -------
+        ids: NumPy array of particle ids.
+        positions: NumPy array of particle positions.
+        profiles: Read-only memory-mapped array of profiles, one row per id.
+        hasprofile: Boolean NumPy array of rows that have a profile.
+        """
+        if self.step < 0:
+            raise Exception('No stored profiles to resume from')
+        
+        if self.complete:
+            raise Exception('Profiles in '+self.directory+' were deleted '
+                            'when the run finished at timestep '
+                            +str(self.step))
+        
+        ids = np.load(self.path('ids',self.buffer)+'.npy')
+        positions = np.load(self.path('positions',self.buffer)+'.npy')
+        hasprofile = np.load(self.path('hasprofile',self.buffer)+'.npy')
+        profiles = np.memmap(self.path('profiles',self.buffer)+'.dat',
+                             dtype=self.dtype,mode='r',
+                             shape=(self.n_rows,self.nodes))
+        
+        return(ids,positions,profiles,hasprofile)
+    
+    def lookup(self,ids):
+        """
+        Get rows of the stored profiles for particle ids (-1 if absent).
+        """
+        stored_ids,positions,profiles,hasprofile = self.load()
+        return(match_ids(stored_ids,ids))
+    
+    def new_profiles(self,n_rows):
+        """
+        Create a writable memory-mapped array for the next timestep in the
+        buffer not used by the last completed step.
+        """
+        buffer = 1-self.buffer
+        path = self.path('profiles',buffer)+'.dat'
+        
+        # Remove rather than overwrite, in case the old file is still mapped
+        if os.path.exists(path):
+            os.remove(path)
+        
+        profiles = np.memmap(path,dtype=self.dtype,mode='w+',
+                             shape=(max(n_rows,1),self.nodes))
+        
+        return(profiles[:n_rows])
+    
+    def commit(self,step,ids,positions,profiles):
+        """
+        Save ids and positions for the profiles written with new_profiles,
+        then mark the timestep as complete.
+        """
+        buffer = 1-self.buffer
+        
+        # Empty slices of a memmap are plain arrays
+        if isinstance(profiles,np.memmap):
+            profiles.flush()
+        
+        # Find rows with profiles in blocks to bound memory
+        hasprofile = np.empty(len(profiles),dtype=bool)
+        for start in range(0,len(profiles),10000):
+            block = profiles[start:start+10000]
+            hasprofile[start:start+10000] = ~np.isnan(block).all(axis=1)
+        
+        np.save(self.path('ids',buffer)+'.npy',ids)
+        np.save(self.path('positions',buffer)+'.npy',positions)
+        np.save(self.path('hasprofile',buffer)+'.npy',hasprofile)
+        
+        self.step = step
+        self.buffer = buffer
+        self.n_rows = len(ids)
+        self.write_marker()
+    
+    def write_marker(self):
+        """
+        Atomically replace the marker of the last completed step.
+        """
+        marker = {'step':self.step,'buffer':self.buffer,'n_rows':self.n_rows,
+                  'nodes':self.nodes,'complete':self.complete}
+        
+        temp_path = self.marker_path+'.tmp'
+        with open(temp_path,'w') as f:
+            json.dump(marker,f)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(temp_path,self.marker_path)
+    
+    def finalize(self):
+        """
+        Delete stored profiles once all timesteps are complete, keeping the
+        marker so that completed timesteps are not rerun.
+        """
+        self.complete = True
+        self.write_marker()
+        
+        for name in os.listdir(self.directory):
+            if not name.startswith('last_step'):
+                os.remove(os.path.join(self.directory,name))
+
+def particle_He_profile(row,inputs,calc_age):
+    
+    """
+    Function to calculate He profile for a particular ASPECT particle, given
+    its row in the current timestep.
+    
+    Particles needing a neighbor's profile are already assigned that 
+    profile's row by He_age_vtk_parallel.
     """
     # Use float32 to reduce memory usage
     dtype=np.float32
     
     # Unpack inputs
-    (k,positions,tree,ids,old_ids,temps,old_profiles,
-     U,Th,radius,time_interval,other_particles,
-     system,He_profile_nodes) = inputs
+    (k,old_rows,temps,old_profiles,
+     U,Th,radius,time_interval,
+     system,He_profile_nodes,temp_resolution,K) = inputs
     
     # Get old profile for current particle if present
-    array = old_profiles[particle==old_ids]
+    old_row = old_rows[row]
      
-    # If array is empty, assign np.nan
-    if array.size == 0:
+    # If not present, assign np.nan
+    if old_row < 0:
         profile = np.empty(He_profile_nodes,dtype=dtype)
         profile.fill(np.nan)
 
     # Otherwise, assign new value from old profile
     else:
-        profile = array 
+        profile = old_profiles[old_row]
     
     # Get particle temperature
-    particle_temp = temps[ids==particle]
-       
-    # If particle not found, don't attempt to calculate profile or age
-    if particle_temp.size == 0:            
+    particle_temp = temps[[row]]
+    
+    # If no profile after first timestep, return original profile of np.nan
+    if (k>0) & (np.all(np.isnan(profile))):
         x = np.empty(He_profile_nodes,dtype=dtype)
         x.fill(np.nan)
         age = np.nan
         output = (age,x)
         return(output)
     
-    # Use previous He from nearest neighbor in previous timestep if none present
-    
-    if (k>0) & (np.all(np.isnan(profile))):
-        
-        if interpolate_profile==True:
-        
-            # Get particle position
-            particle_position = positions[ids==particle]
-            
-            # Find closest particle
-            distance,index = tree.query(particle_position)
-            
-            # Get id of closest particle
-            neighbor_id = other_particles[index]
-            
-            # Get profile of closest particle
-            profile = old_profiles[neighbor_id==old_ids]
-        
-        # If turned off, return original profile of np.nan
-        elif interpolate_profile==False:
-            x = np.empty(He_profile_nodes,dtype=dtype)
-            x.fill(np.nan)
-            age = np.nan
-            output = (age,x)
-            return(output)
-    
     if calc_age==True:
         age,vol,pos,x = tc.forward_model(U,Th,radius,particle_temp,time_interval,system,
                              initial_He=profile.flatten(),calc_age=True,print_age=False,
-                             nodes=He_profile_nodes)
+                             nodes=He_profile_nodes,temp_resolution=temp_resolution,
+                             K=K)
         
         output = (age,x)
         return(output)
@@ -396,13 +1513,77 @@ def particle_He_profile(particle,inputs,calc_age,interpolate_profile):
     else:    
         x = tc.forward_model(U,Th,radius,particle_temp,time_interval,system,
                              initial_He=profile.flatten(),calc_age=False,print_age=False,
-                             nodes=He_profile_nodes)
+                             nodes=He_profile_nodes,temp_resolution=temp_resolution,
+                             K=K)
         age = np.nan
         output = (age,x)
         return(output)
     
     
 
+def chunk_He_profiles(chunk,inputs,calc_age,chunk_size):
+    """
+    Function to calculate He profiles for a contiguous slice of ASPECT 
+    particles.
+    
+    Parameters
+    ----------
+    chunk: Slice of particles (rows of the current timestep) to calculate.
+    inputs: Tuple of shared inputs, as for particle_He_profile.
+    calc_age: Whether to calculate ages.
+    chunk_size: Maximum number of particles to solve together.
+    
+    Returns
+    -------
+    ages: NumPy array of ages for the slice (np.nan if not calculated).
+    profiles: NumPy array of new He profiles for the slice.
+    """
+    dtype=np.float32
+    
+    # Unpack inputs
+    (k,old_rows,temps,old_profiles,
+     U,Th,radius,time_interval,
+     system,He_profile_nodes,temp_resolution,K) = inputs
+    
+    chunk_rows = old_rows[chunk]
+    chunk_temps = temps[chunk]
+    
+    # Get old (or nearest neighbor) profile for each particle if present
+    profiles = np.empty((len(chunk_rows),He_profile_nodes),dtype=dtype)
+    profiles.fill(np.nan)
+    present = chunk_rows >= 0
+    profiles[present] = old_profiles[chunk_rows[present]]
+    
+    # Particles lacking a profile after the first timestep are not calculated
+    if k>0:
+        calculate = ~np.isnan(profiles).all(axis=1)
+    else:
+        calculate = np.ones(len(chunk_rows),dtype=bool)
+    
+    ages = np.empty(len(chunk_rows))
+    ages.fill(np.nan)
+    new_profiles = np.empty((len(chunk_rows),He_profile_nodes),dtype=dtype)
+    new_profiles.fill(np.nan)
+    
+    rows = np.flatnonzero(calculate)
+    for start in range(0,len(rows),chunk_size):
+        batch = rows[start:start+chunk_size]
+        
+        output = tc.forward_model_batch(U,Th,radius,chunk_temps[batch,None],
+                                        time_interval,system,
+                                        nodes=He_profile_nodes,
+                                        initial_He=profiles[batch],
+                                        calc_age=calc_age,
+                                        temp_resolution=temp_resolution,
+                                        K=K)
+        
+        if calc_age==True:
+            ages[batch],new_profiles[batch] = output
+        else:
+            new_profiles[batch] = output
+    
+    return(ages,new_profiles)
+
 def particle_trace(meshes,timesteps,point,y_field,x_field='time',
                    plot_path=False,disable_tqdm=True):
     """
@@ -414,7 +1595,8 @@ def particle_trace(meshes,timesteps,point,y_field,x_field='time',
     
     Parameters
     ----------
-    meshes: MultiBlock object from laod_particle_meshes function
+    meshes: MultiBlock or LazyMeshes object from laod_particle_meshes 
+        function
     timesteps: NumPy array of timesteps to pull
     point: ID of particle to trace
     y_field: Particle property for y-axis
@@ -509,34 +1691,197 @@ def particle_trace(meshes,timesteps,point,y_field,x_field='time',
         
     return(point_df)
 
+def trace_particles(meshes,ids,fields,timesteps=None,tidy=False,
+                    disable_tqdm=True):
+    """
+    Trace many particles and fields over timesteps in one pass.
+    
+    For each timestep, particles are matched by a sorted-id index 
+    (match_ids), so the cost does not grow with one lookup per particle.
+    
+    Parameters
+    ----------
+    meshes: MultiBlock or LazyMeshes object from load_particle_meshes, list 
+        of arrays from load_particle_arrays, or ParticleStore.
+    ids: NumPy array of particle ids to trace.
+    fields: List of particle fields to trace. 'x', 'y', and 'z' give 
+        position coordinates.
+    timesteps: Timesteps (indices of meshes, or timesteps of a 
+        ParticleStore) to trace. The default is None (all).
+    tidy: Whether to return a tidy dataframe instead of an array.
+    
+    Returns
+    -------
+    traces: NumPy array with shape (timesteps, ids, fields), with np.nan 
+        where a particle is absent. If tidy, a Pandas dataframe with columns 
+        timestep, id, and each field, for particles present at each 
+        timestep.
+    """
+    ids = np.atleast_1d(ids)
+    
+    if isinstance(meshes,ParticleStore):
+        if timesteps is None:
+            timesteps = meshes.timesteps
+        steps = (meshes.step(timestep,columns=fields) 
+                 for timestep in timesteps)
+    else:
+        if timesteps is None:
+            timesteps = np.arange(len(meshes))
+        steps = (meshes[timestep] for timestep in timesteps)
+    
+    traces = np.empty((len(timesteps),len(ids),len(fields)))
+    traces.fill(np.nan)
+    
+    for k,step in enumerate(tqdm(steps,total=len(timesteps),
+                                 disable=disable_tqdm)):
+        step_ids,step_fields = step_arrays(step,fields)
+        
+        rows = match_ids(step_ids,ids)
+        present = rows >= 0
+        
+        for j,values in enumerate(step_fields):
+            traces[k,present,j] = values[rows[present]]
+    
+    if tidy == True:
+        timestep_index = np.repeat(timesteps,len(ids))
+        id_index = np.tile(ids,len(timesteps))
+        
+        df = pd.DataFrame(traces.reshape(-1,len(fields)),columns=fields)
+        df.insert(0,'id',id_index)
+        df.insert(0,'timestep',timestep_index)
+        
+        # Keep only particles present at each timestep
+        df = df[~np.isnan(traces).all(axis=2).ravel()].reset_index(drop=True)
+        
+        return(df)
+    
+    return(traces)
+
+def step_arrays(step,fields):
+    """
+    Get particle ids and field values for one timestep of a mesh, arrays 
+    from load_particle_arrays, or dataframe from ParticleStore.
+    """
+    coordinates = {'x':0,'y':1,'z':2}
+    
+    if isinstance(step,pd.DataFrame):
+        step_ids = step.index.values
+        step_fields = [step[field].values for field in fields]
+    
+    elif isinstance(step,dict):
+        step_ids = step['id']
+        step_fields = [step['points'][:,coordinates[field]] 
+                       if field in coordinates else step[field]
+                       for field in fields]
+    
+    else:
+        step_ids = step.point_data['id']
+        step_fields = [step.points[:,coordinates[field]] 
+                       if field in coordinates else step.point_data[field]
+                       for field in fields]
+    
+    return(step_ids,step_fields)
+
 def get_tt_path(all_ids,all_temps,point,disable_tqdm=True):
+    """
+    Get time-temperature path for a particle from the output of 
+    extract_temps_positions.
+    
+    Parameters
+    ----------
+    all_ids: List of NumPy arrays of particle ids for each timestep.
+    all_temps: List of NumPy arrays of temperatures for each timestep.
+    point: ID of particle, or NumPy array of IDs, to get path for.
+    
+    Returns
+    -------
+    tt: NumPy array of temperatures with timesteps along the first axis,
+        and np.nan where the particle is absent.
+    """
     
     # Loop over files
     if disable_tqdm==False:
         print('Finding Tt path...')
       
-    tt = np.zeros(len(all_temps))
+    tt = np.zeros((len(all_temps),)+np.shape(point))
     
     for k,temps in enumerate(tqdm(all_temps,disable=disable_tqdm)):
         
         ids = all_ids[k] # Get particle ids
         
         # Get temp for particular id
-        temp = temps[ids==point]
+        rows = match_ids(ids,point)
         
-        tt[k] = temp
+        tt[k] = np.where(rows>=0,temps[rows],np.nan)
+        
+    return(tt)
+
+def get_tt_paths(all_ids,all_temps,points,fill=None):
+    """
+    Get time-temperature paths for many particles at once from the output 
+    of extract_temps_positions.
+    
+    Builds a dense matrix with one row per particle and one column per 
+    timestep, matching all particles at each timestep with a sorted-id 
+    index. The result can be passed directly as temps to 
+    tchron.forward_model_batch (after removing or filling paths with 
+    np.nan).
+    
+    Parameters
+    ----------
+    all_ids: List of NumPy arrays of particle ids for each timestep.
+    all_temps: List of NumPy arrays of temperatures for each timestep.
+    points: NumPy array of particle IDs to get paths for.
+    fill: How to fill timesteps where a particle is absent. None leaves 
+        np.nan; 'ffill' carries the last temperature forward (timesteps 
+        before a particle first appears stay np.nan). The default is None.
+    
+    Returns
+    -------
+    tt: NumPy array of temperatures with shape (particles, timesteps).
+    """
+    points = np.atleast_1d(points)
+    
+    tt = np.empty((len(points),len(all_temps)))
+    tt.fill(np.nan)
+    
+    for k,temps in enumerate(all_temps):
+        rows = match_ids(all_ids[k],points)
+        present = rows >= 0
+        tt[present,k] = temps[rows[present]]
+    
+    if fill == 'ffill':
+        # Column of last valid temperature for each particle and timestep
+        valid = ~np.isnan(tt)
+        last = np.where(valid,np.arange(tt.shape[1]),0)
+        np.maximum.accumulate(last,axis=1,out=last)
         
+        tt = np.take_along_axis(tt,last,axis=1)
+    
+    elif fill is not None:
+        raise Exception('Fill must be None or ffill')
+    
     return(tt)
 
 def extract_temps_positions(meshes):
+    """
+    Get ids, temperatures, and positions of particles in each mesh of a 
+    MultiBlock or LazyMeshes object, or each timestep from 
+    load_particle_arrays.
+    """
     
     all_ids = []
     all_temps = []
     all_positions = []
     for mesh in meshes:
-        mesh_ids = mesh.point_data['id']
-        mesh_temps = mesh.point_data['T']
-        mesh_positions = mesh.points
+        if isinstance(mesh,dict):
+            mesh_ids = mesh['id']
+            mesh_temps = mesh['T']
+            mesh_positions = mesh['points']
+        else:
+            mesh_ids = mesh.point_data['id']
+            mesh_temps = mesh.point_data['T']
+            mesh_positions = mesh.points
         
         all_ids.append(mesh_ids)
         all_temps.append(mesh_temps)
@@ -591,7 +1936,7 @@ def get_topography(directory,timesteps):
         timesteps_str = str(int(timesteps/5)).zfill(2)
         files = os.path.join(main,prefix+timesteps_str+suffix)
     else:
-        timesteps_str = [str(x/5).zfill(2) for x in timesteps.tolist()]
+        timesteps_str = [str(int(x/5)).zfill(2) for x in timesteps.tolist()]
         files = [os.path.join(main,prefix + x + suffix) for x in timesteps_str]
         
     return(files)
@@ -602,7 +1947,7 @@ def particle_positions(meshes,timestep,bounds=None):
     
     Parameters
     ----------
-    meshes: MultiBlock object from load_particle_meshes
+    meshes: MultiBlock or LazyMeshes object from load_particle_meshes
     timestep: Timestep from which to pull positions.
     
     Returns
@@ -623,26 +1968,46 @@ def particle_positions(meshes,timestep,bounds=None):
 
 def load_particle_meshes(directory,timesteps,save=True,filename='meshes.vtm',
                          bounds=None,parallel=True,
-                         processes = os.cpu_count()-6,kind='particles'):
+                         processes = os.cpu_count()-6,kind='particles',
+                         lazy=False,cache_size=8,prefetch=0):
     """
     Load particle meshes, clip, and save to avoid duplicate computation. This is
     computationally intensive for large meshes and may be preferred to do on 
     Stampede2.
     
+    With lazy=True, nothing is loaded up front. A LazyMeshes collection is 
+    returned instead, which loads and clips each timestep on first access 
+    and keeps at most cache_size in memory.
+    
     Parameters
     ----------
-    directory: Path to directory contaning ASPECT pvtu files.
-    timesteps: Integer or NumPy array of timesteps to pull.
+    directory: Path to directory contaning ASPECT pvtu files, or a list of
+        file paths or Pyvista meshes to use instead.
+    timesteps: Integer or NumPy array of timesteps to pull. Ignored if 
+        directory is a list.
     filename: Name of file to save clipped meshes to.
     bounds: Bounds by which to clip the model box (km)
+    lazy: Whether to return a LazyMeshes collection instead of loading.
+    cache_size: Number of meshes kept in memory if lazy.
+    prefetch: Number of timesteps loaded ahead in worker processes when 
+        iterating if lazy.
     
     Returns
     -------
-    meshes: MultiBlock object of clipped meshes for each timestep.
+    meshes: MultiBlock object of clipped meshes for each timestep, or 
+        LazyMeshes if lazy.
     """
     
     # Set up directory building blocks
-    files=get_pvtu(directory,timesteps,kind=kind)
+    if isinstance(directory,(list,tuple)):
+        files = directory
+    else:
+        files=get_pvtu(directory,timesteps,kind=kind)
+    
+    if lazy == True:
+        meshes = LazyMeshes(files,bounds=bounds,cache_size=cache_size,
+                            prefetch=prefetch,processes=processes)
+        return(meshes)
     
 
     if parallel == True:
@@ -658,13 +2023,8 @@ def load_particle_meshes(directory,timesteps,save=True,filename='meshes.vtm',
     else:
         meshes = pv.MultiBlock()
         for file in tqdm(files):
-            mesh = pv.read(file) # Major computation to load this.
-        
-            # Clip mesh to save space
-            if bounds is not None:
-                km2m = 1000
-                bounds_m = [bound*km2m for bound in bounds]
-                mesh = mesh.clip_box(bounds=bounds_m,invert=False)
+            # Major computation to load this. Clip mesh to save space.
+            mesh = read_mesh(file,bounds,cache=False)
             
             meshes.append(mesh)
             
@@ -674,67 +2034,595 @@ def load_particle_meshes(directory,timesteps,save=True,filename='meshes.vtm',
         
     return(meshes)
 
-def loadclip_parallel(file,bounds):
-    mesh = pv.read(file)
+class LazyMeshes:
+    """
+    Collection of timestep meshes that are loaded and clipped on demand.
     
-    if bounds is not None:
+    Holds only file paths and clip bounds. Indexing loads (and clips) a 
+    timestep on first access and keeps it in a least-recently-used cache of
+    at most cache_size meshes. Iterating loads the next prefetch timesteps
+    ahead in worker processes. Supports len, integer indexing, slicing (a 
+    slice shares the cache), and iteration, so it can be used in place of 
+    the MultiBlock from load_particle_meshes.
+    
+    Parameters
+    ----------
+    files: List of VTU/PVTU file paths, one per timestep.
+    bounds: Bounds (km) by which to clip each mesh. The default is None.
+    cache_size: Maximum number of meshes kept in memory. The default is 8.
+    prefetch: Number of timesteps to load ahead when iterating. The default
+        is 0 (load each timestep when reached).
+    processes: Number of processes used to prefetch.
+    """
+    
+    def __init__(self,files,bounds=None,cache_size=8,prefetch=0,
+                 processes=os.cpu_count()-2,cache=None):
+        self.files = list(files)
+        self.bounds = bounds
+        self.cache_size = cache_size
+        self.prefetch = prefetch
+        self.processes = processes
+        
+        # Cache of meshes by file path, shared with slices
+        if cache is None:
+            cache = OrderedDict()
+        self.cache = cache
+    
+    def __len__(self):
+        return(len(self.files))
+    
+    def __getitem__(self,index):
+        if isinstance(index,slice):
+            return(LazyMeshes(self.files[index],bounds=self.bounds,
+                              cache_size=self.cache_size,
+                              prefetch=self.prefetch,
+                              processes=self.processes,cache=self.cache))
+        
+        file = self.files[index]
+        
+        if file in self.cache:
+            self.cache.move_to_end(file)
+            return(self.cache[file])
+        
+        mesh = read_mesh(file,self.bounds,cache=False)
+        self.store(file,mesh)
+        
+        return(mesh)
+    
+    def __iter__(self):
+        if self.prefetch == 0:
+            for k in range(len(self)):
+                yield self[k]
+            return
+        
+        # Keep meshes already in memory, and load the rest ahead in order
+        resident = {k:self.cache[file] for k,file in enumerate(self.files)
+                    if file in self.cache}
+        missing = [file for k,file in enumerate(self.files) 
+                   if k not in resident]
+        
+        processes = min(self.processes,self.prefetch)
+        with Parallel(n_jobs=processes,pre_dispatch=self.prefetch,
+                      return_as='generator') as parallel:
+            loaded = parallel(delayed(read_mesh)(file,self.bounds,False)
+                              for file in missing)
+            
+            for k,file in enumerate(self.files):
+                if k in resident:
+                    mesh = resident.pop(k)
+                else:
+                    mesh = next(loaded)
+                    self.store(file,mesh)
+                
+                yield mesh
+    
+    def store(self,file,mesh):
+        """
+        Add a mesh to the cache, evicting the least recently used.
+        """
+        self.cache[file] = mesh
+        self.cache.move_to_end(file)
+        
+        while len(self.cache) > self.cache_size:
+            self.cache.popitem(last=False)
+
+def read_shared_arrays(file,bounds=None,fields=['id','T'],name=None):
+    """
+    Read and clip one file in a worker process and copy its points and 
+    fields into shared memory, to be attached by attach_shared_arrays.
+    
+    If name is given, the shared memory for the points and each field is 
+    named name_0, name_1, and so on, so the caller can free it even if the
+    info is never returned (see unlink_shared_arrays).
+    
+    Returns
+    -------
+    info: Dictionary of (shared memory name, shape, dtype) by array name,
+        with the points under 'points'.
+    """
+    mesh = read_mesh(file,bounds,cache=False)
+    
+    arrays = {'points':np.asarray(mesh.points)}
+    for field in fields:
+        arrays[field] = np.asarray(mesh.point_data[field])
+    
+    info = {}
+    try:
+        for j,(array_name,array) in enumerate(arrays.items()):
+            if name is None:
+                shm_name = None
+            else:
+                shm_name = name+'_'+str(j)
+            
+            shm = shared_memory.SharedMemory(name=shm_name,create=True,
+                                             size=max(array.nbytes,1))
+            info[array_name] = (shm.name,array.shape,array.dtype.str)
+            
+            # The parent process takes ownership and unlinks the memory
+            resource_tracker.unregister(shm._name,'shared_memory')
+            
+            np.ndarray(array.shape,dtype=array.dtype,buffer=shm.buf)[...] = array
+            shm.close()
+    except BaseException:
+        # Free memory already written if this file fails
+        for shm_name,shape,dtype in info.values():
+            unlink_shared_memory(shm_name)
+        raise
+    
+    return(info)
+
+def attach_shared_arrays(info):
+    """
+    Copy the shared memory written by read_shared_arrays into NumPy arrays
+    and free it.
+    
+    The arrays own their memory, since arrays made directly on the shared 
+    buffer are left pointing at freed memory once it is closed.
+    """
+    arrays = {}
+    for name,(shm_name,shape,dtype) in info.items():
+        shm = shared_memory.SharedMemory(name=shm_name)
+        
+        try:
+            arrays[name] = np.ndarray(shape,dtype=dtype,buffer=shm.buf).copy()
+        finally:
+            shm.close()
+            shm.unlink()
+    
+    return(arrays)
+
+def unlink_shared_memory(shm_name):
+    """
+    Free shared memory by name, if it still exists.
+    """
+    try:
+        shm = shared_memory.SharedMemory(name=shm_name)
+    except FileNotFoundError:
+        return
+    shm.close()
+    shm.unlink()
+
+def unlink_shared_arrays(name,n_arrays):
+    """
+    Free the shared memory written by read_shared_arrays under a name 
+    (e.g. for files not attached after an error).
+    """
+    for j in range(n_arrays):
+        unlink_shared_memory(name+'_'+str(j))
+
+def iter_shared_arrays(files,bounds=None,fields=['id','T'],
+                       processes=os.cpu_count()-2):
+    """
+    Read files in worker processes with read_shared_arrays and yield the 
+    arrays of each file in order.
+    
+    Each file's shared memory has a name known in advance. If iteration 
+    stops early (an error in a worker or the caller, or an interrupt), the 
+    workers are stopped and the shared memory of every file not yet 
+    attached is freed. Close the generator (e.g. with contextlib.closing) if
+    not consuming it fully.
+    
+    Parameters
+    ----------
+    files: List of file paths.
+    bounds: Bounds by which to clip the model box (km)
+    fields: Particle fields to read. The default is ['id','T'].
+    processes: Number of worker processes.
+    
+    Yields
+    ------
+    arrays: Dictionary of NumPy arrays ('points' and each field).
+    """
+    prefix = 'rp'+secrets.token_hex(4)
+    names = [prefix+'_'+str(k) for k in range(len(files))]
+    n_arrays = len(fields)+1
+    
+    attached = 0
+    with Parallel(n_jobs=processes,return_as='generator') as parallel:
+        output = parallel(delayed(read_shared_arrays)(file,bounds,fields,
+                                                      names[k])
+                          for k,file in enumerate(files))
+        
+        try:
+            for info in output:
+                arrays = attach_shared_arrays(info)
+                attached += 1
+                yield arrays
+        finally:
+            # Stop any workers still running, then free the rest
+            output.close()
+            for name in names[attached:]:
+                unlink_shared_arrays(name,n_arrays)
+
+def load_particle_arrays(directory,timesteps,bounds=None,fields=['id','T'],
+                         processes=os.cpu_count()-2,kind='particles'):
+    """
+    Load particle points and fields for many timesteps in worker processes.
+    
+    Each worker reads and clips one file and returns only the essential 
+    arrays through shared memory rather than pickled VTK objects, so reads
+    run in parallel without the GIL and the parent only copies each array
+    once out of shared memory.
+    
+    Parameters
+    ----------
+    directory: Path to directory contaning ASPECT pvtu files, or a list of
+        file paths.
+    timesteps: Integer or NumPy array of timesteps to pull. Ignored if 
+        directory is a list.
+    bounds: Bounds by which to clip the model box (km)
+    fields: Particle fields to load. The default is ['id','T'].
+    processes: Number of worker processes.
+    
+    Returns
+    -------
+    arrays: List with a dictionary of NumPy arrays ('points' and each 
+        field) for each timestep.
+    """
+    if isinstance(directory,(list,tuple)):
+        files = directory
+    else:
+        files = get_pvtu(directory,timesteps,kind=kind)
+    
+    print('Loading Particle Arrays...')
+    print('Processes: ',processes)
+    
+    files = np.atleast_1d(files).tolist()
+    
+    arrays = []
+    with closing(iter_shared_arrays(files,bounds,fields,processes)) as output:
+        for file_arrays in tqdm(output,total=len(files)):
+            arrays.append(file_arrays)
+    
+    return(arrays)
+
+def build_particle_store(directory,timesteps,path,fields=['T'],bounds=None,
+                         processes=os.cpu_count()-2,kind='particles'):
+    """
+    Convert a series of particle files into one columnar Parquet store.
+    
+    Each timestep is read once (in worker processes, as in 
+    load_particle_arrays) and written as one compressed row group, with 
+    columns timestep, id, x, y, z, and each field, sorted by id. Use 
+    ParticleStore to query it, reading only the rows and columns needed.
+    
+    Parameters
+    ----------
+    directory: Path to directory contaning ASPECT pvtu files, or a list of
+        file paths.
+    timesteps: Integer or NumPy array of timesteps to pull. If directory is 
+        a list, the timestep number of each file.
+    path: Path of the Parquet file to write.
+    fields: Particle fields to store. The default is ['T'].
+    bounds: Bounds by which to clip the model box (km)
+    processes: Number of worker processes.
+    
+    Returns
+    -------
+    store: ParticleStore for the new file.
+    """
+    if pa is None:
+        raise Exception('pyarrow is required for particle stores')
+    
+    timesteps = np.atleast_1d(timesteps)
+    
+    if isinstance(directory,(list,tuple)):
+        files = directory
+    else:
+        files = get_pvtu(directory,timesteps,kind=kind)
+    
+    files = np.atleast_1d(files).tolist()
+    if len(files) != len(timesteps):
+        raise Exception('Got '+str(len(timesteps))+' timesteps for '
+                        +str(len(files))+' files')
+    
+    read_fields = ['id'] + [field for field in fields if field != 'id']
+    
+    print('Building Particle Store...')
+    print('Processes: ',processes)
+    
+    writer = None
+    try:
+        with closing(iter_shared_arrays(files,bounds,read_fields,
+                                        processes)) as output:
+            for step,arrays in zip(tqdm(timesteps),output):
+                # Sort by id so particles can be found by binary search
+                order = np.argsort(arrays['id'],kind='stable')
+                points = arrays['points'][order]
+                
+                columns = {'timestep':np.full(len(order),step,dtype=np.int32),
+                           'id':arrays['id'][order].astype(np.int64),
+                           'x':points[:,0],'y':points[:,1],'z':points[:,2]}
+                for field in read_fields[1:]:
+                    columns[field] = arrays[field][order]
+                
+                table = pa.table(columns)
+                
+                if writer is None:
+                    writer = pq.ParquetWriter(path,table.schema,
+                                              compression='zstd')
+                writer.write_table(table)
+                
+                del arrays
+    finally:
+        if writer is not None:
+            writer.close()
+    
+    return(ParticleStore(path))
+
+class ParticleStore:
+    """
+    Query a Parquet store of particle histories from build_particle_store.
+    
+    Each timestep is one row group, so queries read only the row groups and
+    columns they need.
+    
+    Parameters
+    ----------
+    path: Path of the Parquet file.
+    """
+    
+    def __init__(self,path):
+        if pa is None:
+            raise Exception('pyarrow is required for particle stores')
+        
+        self.path = path
+        self.file = pq.ParquetFile(path)
+        
+        # Timestep of each row group, from the column statistics
+        metadata = self.file.metadata
+        column = self.file.schema_arrow.get_field_index('timestep')
+        self.timesteps = np.array([metadata.row_group(k).column(column)
+                                   .statistics.min
+                                   for k in range(metadata.num_row_groups)])
+        self.fields = [name for name in self.file.schema_arrow.names
+                       if name not in ('timestep','id','x','y','z')]
+    
+    def step(self,timestep,columns=None):
+        """
+        Get all particles at a timestep.
+        
+        Parameters
+        ----------
+        timestep: Timestep to get.
+        columns: List of columns to read. The default is None (all).
+        
+        Returns
+        -------
+        df: Pandas dataframe indexed by particle id.
+        """
+        row_group = np.flatnonzero(self.timesteps==timestep)
+        if row_group.size == 0:
+            raise Exception('Timestep '+str(timestep)+' not in store')
+        
+        if columns is not None:
+            columns = ['id'] + [column for column in columns if column!='id']
+        
+        table = self.file.read_row_group(int(row_group[0]),columns=columns)
+        df = table.to_pandas().set_index('id')
+        
+        return(df)
+    
+    def in_bounds(self,timestep,bounds,columns=None):
+        """
+        Get particles at a timestep within bounds [xmin,xmax,ymin,ymax] (km).
+        """
+        df = self.step(timestep,columns=columns)
+        
+        if columns is not None:
+            positions = self.step(timestep,columns=['x','y'])
+        else:
+            positions = df
+        
         km2m = 1000
-        bounds_m = [bound*km2m for bound in bounds]
-        mesh = mesh.clip_box(bounds=bounds_m,invert=False)
+        inside = ((positions['x']>=bounds[0]*km2m) & 
+                  (positions['x']<=bounds[1]*km2m) &
+                  (positions['y']>=bounds[2]*km2m) & 
+                  (positions['y']<=bounds[3]*km2m))
+        
+        return(df[inside.values])
+    
+    def particle(self,point,columns=None):
+        """
+        Get the full path of one particle.
+        
+        Parameters
+        ----------
+        point: ID of particle.
+        columns: List of columns to read. The default is None (all).
+        
+        Returns
+        -------
+        df: Pandas dataframe indexed by timestep, with only the timesteps 
+            in which the particle is present.
+        """
+        if columns is not None:
+            columns = [column for column in columns 
+                       if column not in ('id','timestep')]
+        
+        rows = []
+        found = []
+        for k,timestep in enumerate(self.timesteps):
+            ids = self.file.read_row_group(k,columns=['id'])['id'].to_numpy()
+            
+            # Ids are sorted within each timestep
+            row = np.searchsorted(ids,point)
+            if (row < len(ids)) and (ids[row]==point):
+                table = self.file.read_row_group(k,columns=columns)
+                rows.append(table.slice(row,1))
+                found.append(timestep)
+        
+        if len(rows) == 0:
+            return(pd.DataFrame())
+        
+        df = pa.concat_tables(rows).to_pandas()
+        df = df.drop(columns=['id','timestep'],errors='ignore')
+        df.index = pd.Index(found,name='timestep')
+        
+        return(df)
+
+def loadclip_parallel(file,bounds):
+    mesh = read_mesh(file,bounds,cache=False)
     
     return(mesh)
 
-def allmeshes_particles(meshes):
+def particle_lifetimes(meshes,disable_tqdm=False):
+    """
+    Get the first and last timestep each particle appears in, in one pass 
+    over a set of meshes.
+    
+    Keeps a sorted array of every id seen so far and merges each timestep 
+    into it with a binary search, so only one timestep needs to be loaded 
+    at a time.
+    
+    Parameters
+    ----------
+    meshes: MultiBlock or LazyMeshes object of meshes, or list of meshes,
+        arrays from load_particle_arrays, dataframes from ParticleStore, or 
+        NumPy arrays of particle ids.
+    
+    Returns
+    -------
+    ids: Sorted NumPy array of every particle id that appears in any mesh.
+    first: NumPy array of first timestep (index into meshes) for each id.
+    last: NumPy array of last timestep for each id.
+    count: NumPy array of number of timesteps each id appears in.
+    """
+    ids = np.zeros(0,dtype=np.int64)
+    first = np.zeros(0,dtype=np.int64)
+    last = np.zeros(0,dtype=np.int64)
+    count = np.zeros(0,dtype=np.int64)
+    
+    for k,mesh in enumerate(tqdm(meshes,disable=disable_tqdm)):
+        if isinstance(mesh,np.ndarray):
+            step_ids = mesh
+        else:
+            step_ids = step_arrays(mesh,[])[0]
+        
+        # Sort ids and drop duplicates
+        step_ids = np.sort(np.asarray(step_ids,dtype=np.int64))
+        if len(step_ids) > 0:
+            step_ids = step_ids[np.r_[True,step_ids[1:]!=step_ids[:-1]]]
+        
+        # Find ids already seen
+        positions = np.searchsorted(ids,step_ids)
+        found = positions < len(ids)
+        found[found] = ids[positions[found]] == step_ids[found]
+        
+        last[positions[found]] = k
+        count[positions[found]] += 1
+        
+        # Insert new ids in sorted order
+        new = ~found
+        ids = np.insert(ids,positions[new],step_ids[new])
+        first = np.insert(first,positions[new],k)
+        last = np.insert(last,positions[new],k)
+        count = np.insert(count,positions[new],1)
+    
+    return(ids,first,last,count)
+
+def allmeshes_particles(meshes,disable_tqdm=False):
     """
     Get particle ids for particles that occur in all of a set of meshes
     
     Parameters
     ----------
-    meshes: MultiBlock object of meshes
+    meshes: MultiBlock or LazyMeshes object of meshes, or any input to
+        particle_lifetimes
     
     Returns
     -------
     all_particles: NumPy array of all particles that occur in all input meshes.
     """
-    all_particles = pv.point_array(meshes[0],'id')
-    
     print('Finding particles that appear in all meshes...')
-    for mesh in tqdm(meshes[1:-1]):
-        mesh_particles = pv.point_array(mesh,'id')
-        common_particles = np.intersect1d(all_particles,mesh_particles)
-        all_particles = common_particles
+    ids,first,last,count = particle_lifetimes(meshes,disable_tqdm)
+    
+    all_particles = ids[count==len(meshes)]
         
     return(all_particles)
 
+def read_topography(file,cache=True):
+    """
+    Read an ASPECT topography file with topography.read_topography_file, 
+    reusing recently parsed files.
+    
+    Parameters
+    ----------
+    file: Path to topography file
+    cache: Whether to keep the parsed file in memory. Files are keyed by
+        path and modification time, so rewritten files are read again.
+    
+    Returns
+    -------
+    topo: NumPy array of surface X and Y positions (columns), sorted by X.
+    """
+    key = (os.path.abspath(file),os.path.getmtime(file))
+    
+    if cache and key in _topography_cache:
+        _topography_cache.move_to_end(key)
+        return(_topography_cache[key])
+    
+    topo = tp.read_topography_file(file)
+    
+    if cache:
+        _topography_cache[key] = topo
+        while len(_topography_cache) > TOPOGRAPHY_CACHE_SIZE:
+            _topography_cache.popitem(last=False)
+    
+    return(topo)
+
 def get_surface_particles(mesh,topography,buffer=100):
     """
     Get particle ids for particles that are at the surface for a given timestep
     
     Parameters
     ----------
-    mesh: Pyvista mesh
-    topography: Directory pointing to topography file
+    mesh: Pyvista mesh, arrays from load_particle_arrays, or dataframe from 
+        ParticleStore
+    topography: Path to topography file, or NumPy array of surface X and Y 
+        positions (e.g. from read_topography)
     buffer: Number of meters below surface to include
     
     Returns
     -------
-    all_particles: NumPy array of all particles that occur in all input meshes.
+    df: DataFrame of positions (X,Y,Z) of surface particles, indexed by id.
     """
-    points = mesh.points
-    ids = mesh.point_data['id']
+    ids,positions = step_arrays(mesh,['x','y','z'])
+    positions = np.column_stack(positions)
     
-    topo = pd.read_csv(topography,delimiter=' ',header=None,skiprows=1)
+    if isinstance(topography,(str,os.PathLike)):
+        topo = read_topography(topography)
+    else:
+        topo = np.asarray(topography)
     
-    surface_ids = []
-    positions = []
     print('Finding Near Surface Particles...')
-    for k,point in enumerate(tqdm(points)):
-        part_id = ids[k]
-        topo_point = np.interp(point[0],topo[0],topo[1])
-        if point[1]>=(topo_point-buffer):
-            surface_ids.append(part_id)
-            positions.append(point)
-    df = pd.DataFrame(positions,index=surface_ids,columns=['X','Y','Z'])
+    
+    # Interpolate topography at all particle X positions at once
+    topo_points = np.interp(positions[:,0],topo[:,0],topo[:,1])
+    surface = positions[:,1] >= (topo_points-buffer)
+    
+    df = pd.DataFrame(positions[surface],index=ids[surface],
+                      columns=['X','Y','Z'])
     
     return(df)
 
@@ -747,7 +2635,8 @@ def surface_all_timesteps(meshes,end_mesh,topography,buffer=100):
     ----------
     meshes: MultiBlock object of meshes
     end_mesh: Mesh to use for surface
-    topography: Directory pointing to topography file
+    topography: Path to topography file, or NumPy array of surface X and Y
+        positions
     buffer: Number of meters below surface to include
     
     Returns
@@ -762,9 +2651,9 @@ def surface_all_timesteps(meshes,end_mesh,topography,buffer=100):
         
 def pull_profile(file,field,x_pos='midpoint'):
     """
-    Pull profile of scalar field from pvtu file.
+    Pull profile of scalar field from pvtu file or Pyvista mesh.
     """
-    mesh = pv.read(file)
+    mesh = read_mesh(file)
     scalar = mesh.point_data[field]
     points = mesh.points
     